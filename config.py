@@ -22,3 +22,122 @@ TELEGRAM_BOT_TOKEN = "TG_BOT_TOKEN"
 
 NTFY_SERVER = "https://ntfy.domain.net"
 NTFY_ACCESS_TOKEN = "NTFY_TOKEN"
+
+# Alertmanager webhook ingestion
+# INGEST_ASYNC = True acknowledges webhooks with 202 as soon as the payload is queued
+# and stores alerts in background ingest workers. A full queue is answered with 503.
+# Payloads of the same Alertmanager group always go to the same worker, in order
+INGEST_ASYNC = False
+INGEST_WORKERS = 2
+INGEST_QUEUE_SIZE = 1000
+INGEST_RETRY_AFTER = 5
+
+# Local on-disk spool for webhook payloads received while PostgreSQL is unavailable.
+# Spooled alerts are replayed into the database once it's healthy again
+SPOOL_ENABLED = True
+SPOOL_DIR = "spool"
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024
+SPOOL_FSYNC_BATCH = 64
+SPOOL_FSYNC_INTERVAL = 1.0
+SPOOL_REPLAY_INTERVAL = 5
+
+# Maintenance windows are kept in an in-memory index that is updated on
+# add/update/delete. Full reload interval (seconds) for changes made outside the API
+MAINTENANCE_INDEX_REFRESH = 300
+
+# In-memory caches (seconds). CACHE_TTL applies to time dependent data such as
+# matching schedules, CACHE_LONG_TTL to pipelines which are invalidated on change.
+# Expired entries are served for up to CACHE_STALE_TTL while a single worker reloads them
+CACHE_TTL = 15
+CACHE_LONG_TTL = 600
+CACHE_STALE_TTL = 60
+CACHE_MAX_ENTRIES = 1024
+
+# Invalidate caches on configuration changes made by other AlertHub instances
+# sharing the database (Postgres LISTEN/NOTIFY)
+CHANGE_LISTENER = True
+
+# Number of compiled notification templates kept in memory
+TEMPLATE_CACHE_SIZE = 256
+
+# Outgoing HTTP connections for Telegram/Ntfy: keep-alive pool size per host
+# (raised to at least NOTIFY_FANOUT_WORKERS + OUTBOX_WORKERS, the threads that
+# send at the same time) and connect/read timeouts in seconds
+HTTP_POOL_SIZE = 20
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 10
+
+# Notification outbox. With NOTIFY_OUTBOX = True notify()/send_message() only queue
+# messages in the database and OUTBOX_WORKERS deliver them, retrying failures with
+# exponential backoff (OUTBOX_BACKOFF_BASE * 2^attempt, capped at OUTBOX_BACKOFF_MAX
+# seconds) until OUTBOX_MAX_ATTEMPTS, after which they are dead-lettered
+NOTIFY_OUTBOX = False
+OUTBOX_WORKERS = 4
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 900
+OUTBOX_RETENTION_DAYS = 7
+
+# Outbound notification rate limits in messages per second, per channel (whole
+# service) and per destination (chat id, ntfy topic, apprise URI). Sends over the
+# limit wait up to RATE_LIMIT_MAX_WAIT seconds for a slot, longer waits are queued
+# in memory (up to RATE_LIMIT_QUEUE_SIZE sends) and sent when a slot is free; the
+# outbox reschedules them in the database instead. A 429 reply holds the destination
+# back for the retry_after the service asks for; direct sends are then retried up
+# to RATE_LIMIT_RETRIES times
+RATE_LIMIT = True
+RATE_LIMIT_CHANNEL = {"telegram": 30, "ntfy": 50, "apprise": 10}
+RATE_LIMIT_DESTINATION = {"telegram": 1, "ntfy": 5, "apprise": 1}
+RATE_LIMIT_MAX_WAIT = 30
+RATE_LIMIT_RETRIES = 2
+RATE_LIMIT_QUEUE_SIZE = 10000
+
+# Notification digests. Pipelines with a digest: section (or calling digest())
+# collect alerts per recipient and channel for DIGEST_WINDOW seconds and send them
+# as one message. Firing alerts with a severity in DIGEST_FLUSH_ON, or DIGEST_MAX_ALERTS
+# pending alerts, send the digest right away
+DIGEST_WINDOW = 60
+DIGEST_MAX_ALERTS = 100
+DIGEST_FLUSH_ON = ["critical"]
+
+# notify() sends an alert's notifications to all recipients and channels at once
+# on a shared pool of NOTIFY_FANOUT_WORKERS threads. Sends not finished within
+# NOTIFY_DEADLINE seconds are reported as failed in the notify() results
+NOTIFY_FANOUT_WORKERS = 16
+NOTIFY_DEADLINE = 30
+
+# Pipeline task scheduling. With PIPELINE_PRIORITY = True alerts are processed by
+# severity instead of arrival order: a firing alert goes ahead of everything queued
+# less than PIPELINE_PRIORITY_BOOST[severity] seconds before it (aging, so lower
+# severities still get through). Other statuses get PIPELINE_RESOLVED_BOOST times the
+# boost of their severity, unknown severities none
+PIPELINE_PRIORITY = False
+PIPELINE_PRIORITY_BOOST = {"critical": 600, "warning": 120, "info": 30}
+PIPELINE_RESOLVED_BOOST = 0.5
+
+# Pipeline worker pool. Starts with PIPELINE_MIN_WORKERS and adds workers up to
+# PIPELINE_MAX_WORKERS while more than PIPELINE_SCALE_BACKLOG tasks per worker are
+# ready to run or the oldest of them waits longer than PIPELINE_SCALE_TASK_AGE seconds
+# (tasks waiting for an earlier task of the same alert don't count).
+# Workers idle for PIPELINE_IDLE_TIMEOUT seconds exit. Keep PIPELINE_MAX_WORKERS well
+# below the database pool size (50), every busy worker may hold a connection
+PIPELINE_MIN_WORKERS = 4
+PIPELINE_MAX_WORKERS = 20
+PIPELINE_SCALE_BACKLOG = 10
+PIPELINE_SCALE_TASK_AGE = 2
+PIPELINE_IDLE_TIMEOUT = 60
+
+# Run pipelines once per Alertmanager webhook group instead of once per alert.
+# Schedules, maintenances and pipelines are then looked up once per group, pipelines
+# with "batch: true" get all alerts of the group in alerts. Alerts stay in order per
+# fingerprint: a group waits for earlier tasks of any of its alerts
+PIPELINE_BATCH = False
+
+# Execution budget of a single pipeline run. A run that executes more than
+# DSL_MAX_STEPS steps, more than DSL_MAX_LOOP_ITERATIONS iterations of one while/for
+# loop or runs longer than DSL_TIMEOUT seconds is stopped and logged with status
+# budget_exceeded. The last PIPELINE_RUN_LOG_SIZE runs are kept for /api/v1/pipelineRuns
+DSL_MAX_STEPS = 100000
+DSL_MAX_LOOP_ITERATIONS = 10000
+DSL_TIMEOUT = 60
+PIPELINE_RUN_LOG_SIZE = 1000
@@ -0,0 +1,75 @@
+def up(cursor):
+    # Applies an incoming Alertmanager alert in a single server-side call:
+    # state transition, alert_count bookkeeping and the AlertsHistory row.
+    # The advisory lock serializes concurrent webhooks for the same fingerprint.
+    cursor.execute('''
+            CREATE OR REPLACE FUNCTION alert_upsert(
+                p_alert_id TEXT,
+                p_alertname TEXT,
+                p_severity TEXT,
+                p_instance TEXT,
+                p_job TEXT,
+                p_status TEXT,
+                p_annotations JSONB,
+                p_labels JSONB,
+                p_generatorURL TEXT,
+                p_updatedAt BIGINT,
+                p_endsAt BIGINT,
+                p_startsAt BIGINT
+            )
+            RETURNS TABLE (out_status TEXT, out_startsAt BIGINT, out_alert_count SMALLINT)
+            LANGUAGE plpgsql
+            AS $$
+            DECLARE
+                cur_status TEXT;
+                cur_count SMALLINT;
+                new_status TEXT;
+                new_count SMALLINT;
+                hist_ts BIGINT;
+            BEGIN
+                PERFORM pg_advisory_xact_lock(hashtext(p_alert_id));
+
+                SELECT a.status, a.alert_count INTO cur_status, cur_count
+                    FROM Alerts a WHERE a.alert_id = p_alert_id LIMIT 1;
+
+                IF NOT FOUND THEN
+                    INSERT INTO Alerts (alert_id, alertname, severity, instance, job, status, annotations, labels, generatorURL, updatedAt, endsAt, startsAt, alert_count)
+                        VALUES (p_alert_id, p_alertname, p_severity, p_instance, p_job, p_status, p_annotations, p_labels, p_generatorURL, p_updatedAt, p_endsAt, p_startsAt, 1);
+                    hist_ts := CASE WHEN p_status = 'resolved' THEN p_endsAt ELSE p_startsAt END;
+                    INSERT INTO AlertsHistory (timestamp, event_timestamp, alert_id, status, comment)
+                        VALUES (p_updatedAt, hist_ts, p_alert_id, p_status, '');
+                    RETURN QUERY SELECT p_status, hist_ts, 1::SMALLINT;
+                    RETURN;
+                END IF;
+
+                new_status := cur_status;
+                new_count := cur_count;
+
+                IF p_status <> cur_status THEN
+                    IF cur_status IN ('muted', 'acked') AND p_status = 'firing' THEN
+                        new_count := cur_count + 1;
+                    ELSIF cur_status IN ('muted', 'acked') AND p_status = 'resolved' THEN
+                        new_count := 1;
+                    ELSIF cur_status IN ('resolved', 'firing') AND p_status IN ('firing', 'resolved') THEN
+                        new_count := 1;
+                    END IF;
+
+                    IF (cur_status, p_status) IN (('acked', 'resolved'), ('resolved', 'firing'), ('firing', 'resolved')) THEN
+                        new_status := p_status;
+                        hist_ts := CASE WHEN p_status = 'firing' THEN p_startsAt ELSE p_endsAt END;
+                        INSERT INTO AlertsHistory (timestamp, event_timestamp, alert_id, status, comment)
+                            VALUES (p_updatedAt, hist_ts, p_alert_id, new_status, '');
+                    END IF;
+
+                    UPDATE Alerts SET status=new_status, updatedAt=p_updatedAt, endsAt=p_endsAt, startsAt=p_startsAt, alert_count=new_count
+                        WHERE alert_id = p_alert_id;
+                ELSIF cur_status = 'firing' THEN
+                    new_count := cur_count + 1;
+                    UPDATE Alerts SET status=new_status, updatedAt=p_updatedAt, endsAt=p_endsAt, startsAt=p_startsAt, alert_count=new_count
+                        WHERE alert_id = p_alert_id;
+                END IF;
+
+                RETURN QUERY SELECT new_status, p_startsAt, new_count;
+            END;
+            $$
+    ''')
@@ -0,0 +1,28 @@
+# CREATE INDEX CONCURRENTLY can't run inside a transaction block,
+# init_db() applies this migration in autocommit mode
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('idx_alerts_alert_id', 'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_alerts_alert_id ON Alerts (alert_id)'),
+    ('idx_alerts_startsat', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alerts_startsat ON Alerts (startsAt)'),
+    ('idx_alertshistory_alert_id_ts', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alertshistory_alert_id_ts ON AlertsHistory (alert_id, timestamp)'),
+    ('idx_alertshistory_event_ts', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alertshistory_event_ts ON AlertsHistory (event_timestamp)'),
+]
+
+def up(cursor):
+    # duplicated fingerprints left by racing upserts would break the unique index, keep the latest row
+    cursor.execute('''
+            DELETE FROM Alerts a
+                USING Alerts b
+                WHERE a.alert_id = b.alert_id AND a.id < b.id
+    ''')
+    for name, sql in INDEXES:
+        # a failed concurrent build leaves an INVALID index behind, drop it before retrying
+        cursor.execute('''
+                SELECT 1 FROM pg_index i
+                    JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = %s AND NOT i.indisvalid
+        ''', (name,))
+        if cursor.fetchone() is not None:
+            cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        cursor.execute(sql)
@@ -0,0 +1,28 @@
+def up(cursor):
+    # Notification deliveries queued by notify()/send_message() and drained by
+    # the outbox workers (utils/outbox.py). idempotency_key makes re-running a
+    # pipeline for the same alert event a no-op for already queued messages.
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS NotificationOutbox (
+                id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                alert_id TEXT,
+                channel SMALLINT NOT NULL,
+                recipient TEXT NOT NULL,
+                destination TEXT NOT NULL,
+                payload JSONB NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts SMALLINT NOT NULL DEFAULT 0,
+                next_attempt_at BIGINT NOT NULL,
+                last_error TEXT,
+                created_at BIGINT NOT NULL,
+                updated_at BIGINT NOT NULL
+            )
+    ''')
+    cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outbox_due ON NotificationOutbox (next_attempt_at)
+                WHERE status IN ('pending', 'sending')
+    ''')
+    cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outbox_alert_id ON NotificationOutbox (alert_id)
+    ''')
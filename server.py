@@ -15,10 +15,19 @@ import base64
 import logging
 import os, signal, sys, atexit
 from threading import Event
+from functools import partial
 
 import config
 from utils.postgres import AlertsDatabase
 from utils.pipeline import AlertPipeline
+from utils.ingest import AlertIngest
+from utils.spool import IngestSpool, SPOOLED
+from utils.cache import cache_stats
+from utils.render import render_template
+from utils import httpclient
+from utils.changes import ChangeListener
+from utils.outbox import NotificationOutbox
+from utils.alert_dsl import send_notification, limiter, deferred_sends
 from utils.pipeline_validator import PipelineValidator
 
 logging.basicConfig(
@@ -31,6 +40,14 @@ logging.basicConfig(
 
 TZ = ZoneInfo(config.TZ)
 
+INGEST_ASYNC = getattr(config, 'INGEST_ASYNC', False)
+INGEST_WORKERS = getattr(config, 'INGEST_WORKERS', 2)
+INGEST_QUEUE_SIZE = getattr(config, 'INGEST_QUEUE_SIZE', 1000)
+INGEST_RETRY_AFTER = getattr(config, 'INGEST_RETRY_AFTER', 5)
+SPOOL_ENABLED = getattr(config, 'SPOOL_ENABLED', False)
+CHANGE_LISTENER = getattr(config, 'CHANGE_LISTENER', True)
+NOTIFY_OUTBOX = getattr(config, 'NOTIFY_OUTBOX', False)
+
 app = Flask(__name__, static_folder='dist')
 
 socketio = SocketIO(app, cors_allowed_origins="*",async_mode="eventlet")
@@ -46,8 +63,17 @@ def cleanup():
     if not shutdown_event.is_set():
         shutdown_event.set()
         logging.info("Cleaning up resources before exit...")
+        if 'listener' in globals():
+            listener.stop()
+        if 'ingest' in globals():
+            ingest.stop()
+        if 'spool' in globals():
+            spool.stop()
         if 'pipeline' in globals():
             pipeline.stop()
+        if 'outbox' in globals() and outbox is not None:
+            outbox.stop()
+        httpclient.close_sessions()
         logging.info("Done")
 
 def handle_signal(signum, frame):
@@ -90,31 +116,82 @@ def serve_static_files(path):
         return send_from_directory(app.static_folder, 'index.html')
 
 
+# Hand stored alerts over to the pipeline and the web UI.
+# group_key is the Alertmanager groupKey of the webhook they came with
+def dispatch_alerts(alerts, group_key=None):
+    alerts = [_alert for _alert in alerts if _alert is not None]
+    pipeline.add_alerts(alerts, group_key)
+    for _alert in alerts:
+        _alert_temp = _alert.copy()
+        starts_at = _alert_temp.get('startsAt',None)
+        ends_at = _alert_temp.get('endsAt', None)
+        updated_at = _alert_temp.get('updatedAt',None)
+        if starts_at is not None:
+            _alert_temp['startsAt'] = datetime.fromtimestamp(starts_at, tz=TZ).isoformat()
+        if ends_at is not None:
+            _alert_temp['endsAt'] = datetime.fromtimestamp(ends_at, tz=TZ).isoformat()
+        if updated_at is not None:
+            _alert_temp['updatedAt'] = datetime.fromtimestamp(updated_at, tz=TZ).isoformat()
+        socketio.emit("alert_update", {"data": _alert_temp})
+
+# Store alerts in the database, or spool them while it's unavailable.
+# Once anything is spooled, new payloads go to the spool as well so that
+# replay preserves per-fingerprint order. Only an unreachable database
+# (upsertBatch() returning None) spools, alerts the database rejects are
+# dead-lettered. Returns the stored alerts, SPOOLED or None if the payload
+# was lost.
+def store_alerts(alerts):
+    if SPOOL_ENABLED and spool.pending():
+        spool.append(alerts)
+        return SPOOLED
+    results = db.upsertBatch(alerts)
+    if results is None:
+        if SPOOL_ENABLED:
+            spool.append(alerts)
+            return SPOOLED
+        return None
+    reject_alerts(alerts, results)
+    return results
+
+# Alerts without a result were malformed or rejected by the database,
+# retrying them can't succeed
+def reject_alerts(alerts, results):
+    rejected = [alert for alert, res in zip(alerts, results) if res is None]
+    if rejected and SPOOL_ENABLED:
+        spool.reject(rejected)
+
+# Replay handler for the spool
+def replay_alerts(alerts):
+    results = db.upsertBatch(alerts)
+    if results is None:
+        return False
+    reject_alerts(alerts, results)
+    dispatch_alerts(results)
+    return True
+
 # Alertmanager Webhook endpoint
 @app.route('/alertmanager', methods=['POST'])
 def alertHook():
     try:
         payload = request.json
-        if payload['alerts'] is not None:
-            for alert in payload['alerts']:
-                _alert = db.upsert(alert)
-                if _alert is not None:
-                    pipeline.add_task("alert", _alert)
-
-                    _alert_temp = _alert.copy()
-                    starts_at = _alert_temp.get('startsAt',None)
-                    ends_at = _alert_temp.get('endsAt', None)
-                    updated_at = _alert_temp.get('updatedAt',None)
-                    if starts_at is not None:
-                        _alert_temp['startsAt'] = datetime.fromtimestamp(starts_at, tz=TZ).isoformat()
-                    if ends_at is not None:
-                        _alert_temp['endsAt'] = datetime.fromtimestamp(ends_at, tz=TZ).isoformat()
-                    if updated_at is not None:
-                        _alert_temp['updatedAt'] = datetime.fromtimestamp(updated_at, tz=TZ).isoformat()
-                    socketio.emit("alert_update", {"data": _alert_temp})
+        alerts = payload['alerts']
+        if alerts is None:
+            return "", 200
+        if not isinstance(alerts, list) or not all(isinstance(a, dict) for a in alerts):
+            return 'Invalid payload', 400
+
+        if INGEST_ASYNC:
+            if not ingest.submit(alerts, payload.get('groupKey')):
+                logging.warning(f"Ingest queue is full, rejecting {len(alerts)} alerts")
+                return 'Ingest queue is full', 503, {'Retry-After': str(INGEST_RETRY_AFTER)}
+            return "", 202
+
+        results = store_alerts(alerts)
+        if results is not None and results is not SPOOLED:
+            dispatch_alerts(results, payload.get('groupKey'))
 
         return "", 200
-    except ValueError:
+    except (ValueError, KeyError, TypeError):
         return 'Invalid JSON', 400
 
 # REST API endpoints
@@ -247,8 +324,31 @@ def alertId():
 
     return jsonify({"alerts": alerts})
 
+# Largest page the list endpoints return, larger limits are refused rather than cut short
+MAX_LIMIT = 1000
+
+# limit query argument, None if it isn't a number between 1 and MAX_LIMIT
+def limit_arg(default):
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        return None
+    if limit < 1 or limit > MAX_LIMIT:
+        return None
+    return limit
+
+# Opaque keyset pagination cursor: (timestamp, id) of the last row of a page
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row[12], row[0]]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+    ts, rid = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    return int(ts), int(rid)
+
 # Return alerts for specific time range
 # Args: from=<ISO Timestamp> to=<ISO Timestamp>
+# Pagination: offset=<N> or after=<cursor from the previous page's "next">
+# count=exact|estimate|none selects how "total" is computed (default exact)
 @app.route('/api/v1/alertsRange', methods=['GET'])
 @jwt_required()
 def alertRange():
@@ -257,7 +357,11 @@ def alertRange():
     status = request.args.get('status', None)
     search = request.args.get('fts', None)
     offset = request.args.get('offset', 0)
-    limit = request.args.get('limit', 500)
+    limit = limit_arg(500)
+    if limit is None:
+        return jsonify({"msg": f"limit must be a number between 1 and {MAX_LIMIT}"}), 400
+    after = request.args.get('after', None)
+    count = request.args.get('count', 'exact')
 
     history = request.args.get('history', False)
     if 'true' in history:
@@ -265,14 +369,22 @@ def alertRange():
     else:
         history = False
 
-    if len(search) < 3:
+    if search is not None and len(search) < 3:
         search = None
 
-    rows = db.queryAlertsRange(range_start=tm_from, range_end=tm_to, fts=search, status=status, offset=offset, limit=limit, history=history)
+    if after:
+        try:
+            after = decode_cursor(after)
+        except (ValueError, TypeError):
+            return jsonify({"msg": "Invalid cursor"}), 400
+    else:
+        after = None
+
+    rows = db.queryAlertsRange(range_start=tm_from, range_end=tm_to, fts=search, status=status, offset=offset, limit=limit, history=history, after=after, total=(count == 'exact'))
 
     alerts = []
     if rows is None:
-        return jsonify({"alerts": alerts, "total": 0})
+        return jsonify({"alerts": alerts, "total": 0, "next": None})
 
     for al in rows:
         updatedAt = datetime.fromtimestamp(al[10], tz=TZ).isoformat()
@@ -299,8 +411,15 @@ def alertRange():
             "alert_count": al[13]
         })
 
-    total = rows[0][14] if len(rows) > 0 and len(rows[0]) > 14 else 0
-    return jsonify({"alerts": alerts, "total": total})
+    if count == 'exact':
+        total = rows[0][14] if len(rows) > 0 and len(rows[0]) > 14 else 0
+    elif count == 'estimate':
+        total = db.estimateAlertsRange(range_start=tm_from, range_end=tm_to, fts=search, status=status, history=history)
+    else:
+        total = None
+
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
+    return jsonify({"alerts": alerts, "total": total, "next": next_cursor})
 
 @app.route('/api/v1/searchSave', methods=['POST'])
 @jwt_required()
@@ -508,6 +627,7 @@ def updateUser():
 
     hashed_pass = hashlib.sha256(password.encode('utf-8')).digest().hex()
     if db.updateUser(name, hashed_pass, user_role, email, notifiers, telegram_id, ntfy, apprise, timezone, pass_update):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -532,6 +652,7 @@ def deleteUser():
         return jsonify({ "msg": "id missing" }), 400
 
     if db.deleteUser(name) and db.deleteUserRefs(int(uid)):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -609,6 +730,7 @@ def updateTeam():
     members = data['members']
 
     if db.updateTeam(int(tid), name, members):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -629,6 +751,7 @@ def deleteTeam():
         return jsonify({ "msg": "id missing" }), 400
 
     if db.deleteTeam(int(tid)):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -681,6 +804,7 @@ def addSchedule():
     mute_starts = data['mute_starts']
 
     if db.addSchedule(name, group_id, starts_at, ends_at, mute_starts, mute_ends, people):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -710,6 +834,7 @@ def updateSchedule():
     mute_starts = data['mute_starts']
 
     if db.updateSchedule(sid, name, group_id, starts_at, ends_at, mute_starts, mute_ends, people):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -722,6 +847,7 @@ def deleteSchedule():
         return jsonify({ "msg": "id missing" }), 400
 
     if db.deleteSchedule(sid):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -764,6 +890,7 @@ def addScheduleGroup():
     team_id = data['team_id']
 
     if db.addScheduleGroup(name, pipeline_id, team_id):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -787,6 +914,7 @@ def updateScheduleGroup():
     team_id = data['team_id']
 
     if db.updateScheduleGroup(sid, name, pipeline_id, team_id):
+        pipeline.invalidate_schedules()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -799,6 +927,8 @@ def deleteScheduleGroup():
         return jsonify({ "msg": "id missing" }), 400
 
     if db.deleteScheduleGroup(gid):
+        pipeline.invalidate_schedules()
+        pipeline.invalidate_maintenance()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -846,6 +976,7 @@ def addMaintenance():
     ends_at = datetime.fromisoformat(data['ends_at']).timestamp()
 
     if db.addMaintenance(name, description, filter, ocgroups, starts_at, ends_at):
+        pipeline.invalidate_maintenance()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -871,6 +1002,7 @@ def updateMaintenance():
     ends_at = datetime.fromisoformat(data['ends_at']).timestamp()
 
     if db.updateMaintenance(mid, name, description, filter, ocgroups, starts_at, ends_at):
+        pipeline.invalidate_maintenance(mid)
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -883,6 +1015,7 @@ def deleteMaintenance():
         return jsonify({ "msg": "id missing" }), 400
 
     if db.deleteMaintenance(mid):
+        pipeline.invalidate_maintenance(mid)
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -948,6 +1081,7 @@ def updatePipeline():
     yaml_content = data['yaml_content']
 
     if db.updatePipeline(pid, name, description, yaml_content):
+        pipeline.invalidate_pipeline(pid)
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -960,6 +1094,7 @@ def deletePipeline():
         return jsonify({ "msg": "id missing" }), 400
 
     if db.deletePipeline(pid):
+        pipeline.invalidate_pipeline(pid)
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -1002,6 +1137,7 @@ def addTemplate():
     template = data['template']
 
     if db.addTemplate(name, description, template):
+        pipeline.invalidate_template()
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -1025,6 +1161,7 @@ def updateTemplate():
     template = data['template']
 
     if db.updateTemplate(tid, name, description, template):
+        pipeline.invalidate_template(tid)
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -1037,6 +1174,7 @@ def deleteTemplate():
         return jsonify({ "msg": "id missing" }), 400
 
     if db.deleteTemplate(tid):
+        pipeline.invalidate_template(tid)
         return jsonify({ "msg": "ok" }), 200
     else:
         return jsonify({ "msg": "DB Error" }), 500
@@ -1084,6 +1222,106 @@ def getAlertStats():
 
     return jsonify({"status": status, "severity": severity, "alert_name": alert_name})
 
+@app.route('/api/v1/ingestStats', methods=['GET'])
+@jwt_required()
+def getIngestStats():
+    stats = {"async": INGEST_ASYNC}
+    if INGEST_ASYNC:
+        stats.update(ingest.stats())
+    if SPOOL_ENABLED:
+        stats["spool"] = spool.stats()
+    return jsonify(stats)
+
+# Notification outbox
+@app.route('/api/v1/notifications', methods=['GET'])
+@jwt_required()
+def getNotifications():
+    alert_id = request.args.get('alert_id', None)
+    status = request.args.get('status', None)
+    limit = limit_arg(100)
+    if limit is None:
+        return jsonify({"msg": f"limit must be a number between 1 and {MAX_LIMIT}"}), 400
+    rows = db.getNotifications(alert_id, status, limit)
+    if rows is False:
+        return jsonify({ "msg": "DB Error" }), 500
+    notifications = [
+        {
+            "id": r[0],
+            "alert_id": r[1],
+            "channel": r[2],
+            "recipient": r[3],
+            "status": r[4],
+            "attempts": r[5],
+            "next_attempt_at": datetime.fromtimestamp(r[6], tz=TZ).isoformat(),
+            "last_error": r[7],
+            "created_at": datetime.fromtimestamp(r[8], tz=TZ).isoformat(),
+            "updated_at": datetime.fromtimestamp(r[9], tz=TZ).isoformat()
+        }
+        for r in rows
+    ]
+    return jsonify(notifications)
+
+@app.route('/api/v1/retryNotification', methods=['GET'])
+@jwt_required()
+def retryNotification():
+    nid = request.args.get('id', None)
+    if nid is None:
+        return jsonify({ "msg": "id missing" }), 400
+    res = db.retryNotification(nid)
+    if res is None:
+        return jsonify({ "msg": "No dead-lettered notification with this id" }), 404
+    if not res:
+        return jsonify({ "msg": "DB Error" }), 500
+    if NOTIFY_OUTBOX:
+        outbox.wakeup.set()
+    return jsonify({ "msg": "ok" }), 200
+
+@app.route('/api/v1/outboxStats', methods=['GET'])
+@jwt_required()
+def getOutboxStats():
+    stats = {"enabled": NOTIFY_OUTBOX}
+    if NOTIFY_OUTBOX:
+        stats.update(outbox.stats())
+    return jsonify(stats)
+
+@app.route('/api/v1/pipelineStats', methods=['GET'])
+@jwt_required()
+def getPipelineStats():
+    return jsonify(pipeline.stats())
+
+@app.route('/api/v1/pipelineRuns', methods=['GET'])
+@jwt_required()
+def getPipelineRuns():
+    status = request.args.get('status', None)
+    limit = limit_arg(100)
+    if limit is None:
+        return jsonify({"msg": f"limit must be a number between 1 and {MAX_LIMIT}"}), 400
+    runs = [
+        {**run, "started_at": datetime.fromtimestamp(run["started_at"], tz=TZ).isoformat()}
+        for run in pipeline.get_run_log(status, limit)
+    ]
+    return jsonify(runs)
+
+@app.route('/api/v1/digestStats', methods=['GET'])
+@jwt_required()
+def getDigestStats():
+    return jsonify(pipeline.digests.stats())
+
+@app.route('/api/v1/rateLimitStats', methods=['GET'])
+@jwt_required()
+def getRateLimitStats():
+    if limiter is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **limiter.stats(), "deferred_sends": deferred_sends.stats()})
+
+@app.route('/api/v1/cacheStats', methods=['GET'])
+@jwt_required()
+def getCacheStats():
+    stats = cache_stats()
+    if CHANGE_LISTENER:
+        stats["listener"] = listener.stats()
+    return jsonify(stats)
+
 # Utils
 @app.route('/api/v1/renderTemplate', methods=['POST'])
 @jwt_required()
@@ -1103,13 +1341,7 @@ def renderTemplate():
 
     try:
         alert = json.loads(alert_json)
-        env = jinja2.Environment(
-            autoescape=False,
-            trim_blocks=False,
-            lstrip_blocks=False
-            )
-        tpl = env.from_string(template)
-        result = tpl.render(alert)
+        result = render_template(template, alert, cache=False)
     except (json.JSONDecodeError, jinja2.TemplateError) as e:
         logging.error("Error processing alert: %s", e, exc_info=True)
         result = str(e)
@@ -1155,9 +1387,36 @@ if __name__ == '__main__':
     except:
         raise Exception("Failed to initialize database")
 
-    pipeline = AlertPipeline(db)
+    outbox = None
+    if NOTIFY_OUTBOX:
+        # Rate limited sends are rescheduled rather than holding a delivery worker
+        outbox = NotificationOutbox(db, partial(send_notification, max_wait=1),
+                                    num_workers=config.OUTBOX_WORKERS,
+                                    max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+                                    backoff_base=config.OUTBOX_BACKOFF_BASE,
+                                    backoff_max=config.OUTBOX_BACKOFF_MAX,
+                                    retention_days=config.OUTBOX_RETENTION_DAYS)
+        outbox.start()
+
+    pipeline = AlertPipeline(db, outbox=outbox)
     pipeline.start()
 
+    if CHANGE_LISTENER:
+        listener = ChangeListener(config.DATABASE_URL, db.CHANGES_CHANNEL, pipeline.apply_change, origin=db.instance_id)
+        listener.start()
+
+    if SPOOL_ENABLED:
+        spool = IngestSpool(config.SPOOL_DIR,
+                            segment_size=config.SPOOL_SEGMENT_SIZE,
+                            fsync_batch=config.SPOOL_FSYNC_BATCH,
+                            fsync_interval=config.SPOOL_FSYNC_INTERVAL,
+                            replay_interval=config.SPOOL_REPLAY_INTERVAL)
+        spool.start(replay_alerts, db.ping)
+
+    if INGEST_ASYNC:
+        ingest = AlertIngest(store_alerts, dispatch_alerts, num_workers=INGEST_WORKERS, queue_size=INGEST_QUEUE_SIZE)
+        ingest.start()
+
     try:
         socketio.run(app, host=config.LISTEN_ADDRESS, port=config.LISTEN_PORT)
     finally:
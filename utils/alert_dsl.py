@@ -1,6 +1,11 @@
 from enum import IntEnum
 import yaml, json
+import hashlib
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, time, timezone
+from time import monotonic
 from zoneinfo import ZoneInfo
 from typing import Any, Dict, List, Union
 from simpleeval import SimpleEval, NameNotDefined, InvalidExpression
@@ -9,9 +14,22 @@ import config
 from utils.telegram import TelegramNotify
 from utils.ntfy import NtfyNotify
 from utils.apprise import AppriseNotify
+from utils.maintenance import compile_filter
+from utils.templates import TemplateRegistry
+from utils.render import render_template
+from utils.outbox import NotificationOutbox
+from utils.ratelimit import RateLimiter, DeferredSends
 
 TZ = ZoneInfo(config.TZ)
 
+DSL_MAX_STEPS = getattr(config, 'DSL_MAX_STEPS', 100000)
+DSL_MAX_LOOP_ITERATIONS = getattr(config, 'DSL_MAX_LOOP_ITERATIONS', 10000)
+DSL_TIMEOUT = getattr(config, 'DSL_TIMEOUT', 60)
+
+# Raised by the interpreter when a run goes over its execution budget
+class BudgetExceeded(Exception):
+    pass
+
 class NotifyChannel(IntEnum):
     NONE = 0
     EMAIL = 1
@@ -19,83 +37,227 @@ class NotifyChannel(IntEnum):
     NTFY = 3
     APPRISE = 4
 
+# Expression as written in a pipeline, with the {{ }} wrapper stripped and the
+# code parsed into an AST once at compile time. Parse errors are kept and
+# reported when the expression is evaluated, same as before.
+class Expression:
+    __slots__ = ("source", "code", "node", "error")
+
+    def __init__(self, value):
+        self.source = value
+        self.node = None
+        self.error = None
+        if isinstance(value, str):
+            expr = value.strip()
+            if expr.startswith("{{") and expr.endswith("}}"):
+                self.code = expr[2:-2].strip()
+            else:
+                self.code = expr
+            try:
+                self.node = SimpleEval.parse(self.code)
+            except Exception as e:
+                self.error = e
+        else:
+            self.code = None
+
+def is_template_expr(value):
+    return isinstance(value, str) and value.startswith("{{") and value.endswith("}}")
+
+# Pipeline YAML parsed and validated once into an immutable step tree:
+#   ("print", expr)                      ("set", ((key, expr), ...))
+#   ("if", cond, then_steps, else_steps) ("while", cond, steps)
+#   ("for", var, expr, steps)            ("call", expr)
+#   ("unknown", raw_step)
+class CompiledPipeline:
+    def __init__(self, dsl):
+        if dsl is None:
+            dsl = {}
+        if not isinstance(dsl, dict):
+            raise ValueError("pipeline must be a mapping")
+        self.variables = tuple(
+            (key, Expression(value) if is_template_expr(value) else None, value)
+            for key, value in (dsl.get("vars") or {}).items()
+        )
+        templates = []
+        for key, value in (dsl.get("templates") or {}).items():
+            if is_template_expr(value):
+                templates.append((key, "expr", Expression(value)))
+            elif isinstance(value, int):
+                templates.append((key, "id", value))
+            else:
+                templates.append((key, "raw", value))
+        self.templates = tuple(templates) if "templates" in dsl else None
+        self.template_ids = tuple(value for _, kind, value in templates if kind == "id")
+        # batch: true runs the pipeline once per webhook group instead of once per alert
+        self.batch = bool(dsl.get("batch", False))
+        # digest: section, notify() calls of the pipeline are coalesced into digests
+        self.digest_options = None
+        options = dsl.get("digest")
+        if options is True:
+            options = {}
+        if isinstance(options, dict):
+            self.digest_options = {
+                "window": options.get("window"),
+                "templates": dict(options.get("templates") or {}),
+                "flush_on": tuple(options.get("flush_on", DIGEST_FLUSH_ON)),
+            }
+        self.steps = self.compile_steps(dsl.get("steps") or [])
+
+    def compile_steps(self, steps):
+        if isinstance(steps, dict):
+            steps = [steps]
+        return tuple(self.compile_step(step) for step in steps)
+
+    def compile_step(self, step):
+        if not isinstance(step, dict):
+            return ("unknown", step)
+        if "print" in step:
+            return ("print", Expression(step["print"]))
+        elif "set" in step:
+            return ("set", tuple((key, Expression(value)) for key, value in step["set"].items()))
+        elif "if" in step:
+            return ("if",
+                    Expression(step["if"]["condition"]),
+                    self.compile_steps(step["if"].get("then", [])),
+                    self.compile_steps(step["if"].get("else", [])))
+        elif "while" in step:
+            return ("while", Expression(step["while"]["condition"]), self.compile_steps(step["while"]["steps"]))
+        elif "for" in step:
+            return ("for",
+                    step["for"]["var"],
+                    Expression(step["for"]["in"]),
+                    self.compile_steps(step["for"].get("steps", [])))
+        elif "call" in step:
+            return ("call", Expression(step["call"]))
+        return ("unknown", step)
+
+def compile_pipeline(script: str):
+    try:
+        dsl = yaml.safe_load(script)
+    except yaml.YAMLError as e:
+        logging.error(f"YAML parsing error: {e}")
+        return None
+    try:
+        return CompiledPipeline(dsl)
+    except KeyError as e:
+        logging.error(f"Pipeline compile error: missing key {e}")
+        return None
+    except (TypeError, AttributeError, ValueError) as e:
+        logging.error(f"Pipeline compile error: {e}")
+        return None
+
 class AlertDSL:
-    def __init__(self, db_h, alert, schedule, maintenance):
+    def __init__(self, db_h, alert, schedule, maintenance, maintenance_index=None, templates=None, outbox=None, digests=None, alerts=None):
         self.context = None
+        self.evaluator = None
         self.db = db_h
+        self.outbox = outbox
+        self.digests = digests
+        self.digest_options = None
+        # Execution budget of a run: steps executed, iterations of any single
+        # loop and wall clock time. Checked between steps, so a builtin that is
+        # already running (notify() waiting on the network) is not interrupted
+        self.max_steps = DSL_MAX_STEPS
+        self.max_loop_iterations = DSL_MAX_LOOP_ITERATIONS
+        self.timeout = DSL_TIMEOUT
+        self.steps = 0
+        self.deadline = None
+        self.events = []
+        self.templates = templates if templates is not None else TemplateRegistry(db_h)
         self.VARIABLES = {
             "alert": alert,
+            "alerts": alerts if alerts is not None else ([alert] if alert is not None else []),
             "schedule": schedule,
             "maintenances": maintenance,
             "NotifyChannel": NotifyChannel
         }
         self.BUILTIN_FUNCTIONS = {
             "log_info": lambda *args: log_info(*args),
-            "notify": lambda *args, **kwargs: notify(*args, **kwargs, __context__=self.context, __db__=self.db),
-            "send_message": send_message,
+            "notify": lambda *args, **kwargs: self.notify(*args, **kwargs),
+            "digest": lambda *args, **kwargs: digest(*args, **kwargs, __context__=self.context, __templates__=self.templates,
+                                                     __digest__=self.digests, __options__=self.digest_options, __outbox__=self.outbox),
+            "send_message": lambda *args, **kwargs: send_message(*args, **kwargs, __context__=self.context, __outbox__=self.outbox),
             "mute_time": lambda: check_mute_time(__context__=self.context),
-            "maintenance": lambda: check_maintenance(__context__=self.context),
+            "maintenance": lambda: check_maintenance(__context__=self.context, __index__=maintenance_index),
         }
 
-    def run_dsl(self, script: str):
-        try:
-            dsl = yaml.safe_load(script)
-        except yaml.YAMLError as e:
-            logging.error(f"YAML parsing error: {e}")
-            return None
+    # script is either pipeline YAML or a CompiledPipeline
+    def run_dsl(self, script):
+        if isinstance(script, CompiledPipeline):
+            program = script
+        else:
+            program = compile_pipeline(script)
+            if program is None:
+                return None
 
+        self.digest_options = program.digest_options
+        self.steps = 0
+        self.deadline = monotonic() + self.timeout
+        self.events = []
         self.context = self.VARIABLES.copy()
+        # One evaluator per run, resolving names straight from the live context
+        self.evaluator = SimpleEval(names=self.context, functions=self.BUILTIN_FUNCTIONS)
 
-        if "vars" in dsl:
-            for key, value in dsl["vars"].items():
-                if isinstance(value, str) and value.startswith("{{") and value.endswith("}}"):
-                    self.context[key] = self.evaluate_expression(value)
-                else:
-                    self.context[key] = value
+        for key, expr, value in program.variables:
+            if expr is not None:
+                self.context[key] = self.evaluate_expression(expr)
+            else:
+                self.context[key] = value
 
-        if "templates" in dsl:
+        if program.templates is not None:
             self.context['templates'] = {}
-            for key, value in dsl["templates"].items():
-                if isinstance(value, str) and value.startswith("{{") and value.endswith("}}"):
+            loaded = self.templates.get_many(program.template_ids)
+            for key, kind, value in program.templates:
+                if kind == "expr":
                     self.context['templates'][key] = self.evaluate_expression(value)
-                elif isinstance(value, int):
-                    res = self.db.getTemplate(value)
-                    if res is not None:
-                        tpl = res[3]
-                    else:
+                elif kind == "id":
+                    tpl = loaded.get(value)
+                    if tpl is None:
                         logging.error(f"Error loading template ID {value}")
                         tpl = ''
                     self.context['templates'][key] = tpl
                 else:
                     self.context['templates'][key] = value
 
-        if "steps" in dsl:
-            for step in dsl["steps"]:
+        try:
+            for step in program.steps:
                 self.execute_step(step)
+        except BudgetExceeded as e:
+            logging.error(f"Pipeline run stopped: {e}")
+            self.events.append({"event": "BudgetExceeded", "message": str(e), "steps": self.steps})
 
         return self.context
 
-    def evaluate_expression(self, expr: str) -> Any:
-        if not isinstance(expr, str):
-            return expr
-
-        expr = expr.strip()
-        if expr.strip().startswith("{{") and expr.strip().endswith("}}"):
-            code = expr.strip()[2:-2].strip()
-        else:
-            code = expr
-
-        evaluator = SimpleEval()
-        evaluator.names = {
-            **self.VARIABLES,
-            **self.context
-        }
-        evaluator.functions = {
-            **self.BUILTIN_FUNCTIONS,
-        }
+    def check_budget(self):
+        self.steps += 1
+        if self.steps > self.max_steps:
+            raise BudgetExceeded(f"more than {self.max_steps} steps executed")
+        if monotonic() > self.deadline:
+            raise BudgetExceeded(f"run took longer than {self.timeout}s")
+
+    def check_iterations(self, iterations, kind):
+        if iterations > self.max_loop_iterations:
+            raise BudgetExceeded(f"{kind} loop ran more than {self.max_loop_iterations} iterations")
+
+    # In pipelines with a digest: section notify() adds the alert to the digests,
+    # its per-alert templates don't apply there
+    def notify(self, *args, **kwargs):
+        if self.digest_options is not None and self.digests is not None:
+            return digest(__context__=self.context, __templates__=self.templates, __digest__=self.digests,
+                          __options__=self.digest_options, __outbox__=self.outbox)
+        return notify(*args, **kwargs, __context__=self.context, __templates__=self.templates, __outbox__=self.outbox)
+
+    def evaluate_expression(self, expr) -> Any:
+        if not isinstance(expr, Expression):
+            expr = Expression(expr)
+        if expr.code is None:
+            return expr.source
+        code = expr.code
 
         try:
-            return evaluator.eval(code)
+            if expr.error is not None:
+                raise expr.error
+            return self.evaluator.eval(code, previously_parsed=expr.node)
         except NameNotDefined as e:
             logging.error(f"Variable not defined: {e}")
         except InvalidExpression as e:
@@ -103,176 +265,63 @@ class AlertDSL:
         except Exception as e:
             logging.error(f"Code exception '{code}': {e}")
 
-    def execute_step(self, step: Dict):
-        if "print" in step:
-            value = self.evaluate_expression(step["print"])
+    def execute_step(self, step):
+        self.check_budget()
+        kind = step[0]
+        if kind == "print":
+            value = self.evaluate_expression(step[1])
             logging.info(value)
 
-        elif "set" in step:
-            for key, value_expr in step["set"].items():
+        elif kind == "set":
+            for key, value_expr in step[1]:
                 value = self.evaluate_expression(value_expr)
                 self.context[key] = value
 
-        elif "if" in step:
-            cond = self.evaluate_expression(step["if"]["condition"])
-            branch = "then" if cond else "else"
-            for substep in step["if"].get(branch, []):
+        elif kind == "if":
+            cond = self.evaluate_expression(step[1])
+            for substep in (step[2] if cond else step[3]):
                 self.execute_step(substep)
 
-        elif "while" in step:
-            while self.evaluate_expression(step["while"]["condition"]):
-                for substep in step["while"]["steps"]:
+        elif kind == "while":
+            iterations = 0
+            while self.evaluate_expression(step[1]):
+                iterations += 1
+                self.check_iterations(iterations, "while")
+                self.check_budget()
+                for substep in step[2]:
                     self.execute_step(substep)
 
-        elif "for" in step:
-            var_name = step["for"]["var"]
-            iterable_expr = step["for"]["in"]
-            substeps = step["for"].get("steps", [])
+        elif kind == "for":
+            var_name, iterable_expr, substeps = step[1], step[2], step[3]
 
             iterable = self.evaluate_expression(iterable_expr)
 
             if not hasattr(iterable, '__iter__'):
-                logging.error(f"Not iterable expression: '{iterable_expr}'")
+                logging.error(f"Not iterable expression: '{iterable_expr.source}'")
                 return None
 
-            for value in iterable:
+            for iterations, value in enumerate(iterable, 1):
+                self.check_iterations(iterations, "for")
+                self.check_budget()
                 self.context[var_name] = value
                 for substep in substeps:
                     self.execute_step(substep)
 
-        elif "call" in step:
-            call_expr = step["call"]
-            result = self.evaluate_expression(call_expr)
+        elif kind == "call":
+            result = self.evaluate_expression(step[1])
             if result is not None:
                 logging.info(f"[CALL] result: {result}")
         else:
-            logging.error(f"Unknown step: {step}")
+            logging.error(f"Unknown step: {step[1]}")
 
+# Kept for callers evaluating a filter against a single alert,
+# compiled filters are cached in utils.maintenance
 class FilterParser:
     def __init__(self, data):
         self.data = data
 
     def parse_and_evaluate(self, expression: str) -> bool:
-        expression = expression.strip()
-        or_parts = self._split_by_operator(expression, '||')
-        if len(or_parts) > 1:
-            results = []
-            for part in or_parts:
-                results.append(self._evaluate_and_expression(part.strip()))
-            return any(results)
-        return self._evaluate_and_expression(expression)
-
-    def _split_by_operator(self, expression: str, operator: str) -> list:
-        parts = []
-        current = ""
-        i = 0
-        while i < len(expression):
-            if expression[i] == '(':
-                paren_count = 1
-                j = i + 1
-                while j < len(expression) and paren_count > 0:
-                    if expression[j] == '(':
-                        paren_count += 1
-                    elif expression[j] == ')':
-                        paren_count -= 1
-                    j += 1
-                current += expression[i:j]
-                i = j
-            elif i <= len(expression) - len(operator) and expression[i:i+len(operator)] == operator:
-                parts.append(current.strip())
-                current = ""
-                i += len(operator)
-            else:
-                current += expression[i]
-                i += 1
-        parts.append(current.strip())
-        return parts
-
-    def _evaluate_and_expression(self, expression: str) -> bool:
-        and_parts = self._split_by_operator(expression, '&')
-        if len(and_parts) > 1:
-            results = []
-            for part in and_parts:
-                results.append(self._evaluate_condition(part.strip()))
-            return all(results)
-
-        return self._evaluate_condition(expression)
-
-    def _get_nested_value(self, key_path: str) -> Any:
-        keys = key_path.split('.')
-        current = self.data
-        for key in keys:
-            if isinstance(current, dict) and key in current:
-                current = current[key]
-            else:
-                raise KeyError(f"Key path '{key_path}' not found in alert data")
-        return current
-
-    def _evaluate_condition(self, condition: str) -> bool:
-        if condition.startswith('(') and condition.endswith(')'):
-            paren_count = 0
-            is_properly_enclosed = True
-            for i, char in enumerate(condition[:-1]):
-                if char == '(':
-                    paren_count += 1
-                elif char == ')':
-                    paren_count -= 1
-                    if paren_count == 0 and i != len(condition) - 2:
-                        is_properly_enclosed = False
-                        break
-            if is_properly_enclosed:
-                return self.parse_and_evaluate(condition[1:-1])
-
-        operators = ['==', '!=', '>=', '<=', '>', '<']
-        for op in operators:
-            if op in condition:
-                parts = condition.split(op, 1)
-                if len(parts) == 2:
-                    left = parts[0].strip()
-                    right = parts[1].strip()
-
-                    if (right.startswith('"') and right.endswith('"')) or \
-                       (right.startswith("'") and right.endswith("'")):
-                        right = right[1:-1]
-
-                    return self._compare_values(left, op, right)
-        raise ValueError(f"Invalid condition: {condition}")
-
-    def _compare_values(self, left: str, operator: str, right: str) -> bool:
-        try:
-            left_value = self._get_nested_value(left)
-        except KeyError as e:
-            raise ValueError(f"Field '{left}' not found in alert data")
-        try:
-            if right.isdigit() or (right.startswith('-') and right[1:].isdigit()):
-                right_value = int(right)
-                if isinstance(left_value, str) and left_value.isdigit():
-                    left_value = int(left_value)
-                elif isinstance(left_value, str) and left_value.replace('.', '').replace('-', '').isdigit():
-                    left_value = float(left_value)
-            elif right.replace('.', '').replace('-', '').isdigit():
-                right_value = float(right)
-                if isinstance(left_value, str) and left_value.replace('.', '').replace('-', '').isdigit():
-                    left_value = float(left_value)
-            else:
-                right_value = right
-        except:
-            right_value = right
-
-        if operator == '==':
-            return left_value == right_value
-        elif operator == '!=':
-            return left_value != right_value
-        elif operator == '>':
-            return left_value > right_value
-        elif operator == '<':
-            return left_value < right_value
-        elif operator == '>=':
-            return left_value >= right_value
-        elif operator == '<=':
-            return left_value <= right_value
-        else:
-            raise ValueError(f"Unsupported operator: {operator}")
+        return compile_filter(expression).evaluate(self.data)
 
 
 def check_mute_time(__context__=None):
@@ -309,7 +358,10 @@ def check_mute_time(__context__=None):
         logging.debug("mute_time(): not muted")
         return False
 
-def check_maintenance(__context__=None):
+# An alert is in maintenance when any active window of its on-call group
+# (or a global one) matches. __index__ is a MaintenanceIndex, without it
+# the windows from the context are scanned one by one.
+def check_maintenance(__context__=None, __index__=None):
     mnts = __context__.get('maintenances', None)
     if mnts is None:
         logging.warning("maintenance(): No maintenances found")
@@ -324,59 +376,134 @@ def check_maintenance(__context__=None):
         return None
     g_id = schedule.get('group_id', None)
 
-    parser = FilterParser(alert)
+    if __index__ is not None:
+        mnt = __index__.match(alert, g_id)
+        if mnt is not None:
+            logging.info(f"maintenance(): True ({mnt['name']})")
+            return True
+        logging.info("maintenance(): False")
+        return False
+
     for mnt in mnts:
         try:
             if g_id in mnt['oncall_groups'] or len(mnt['oncall_groups']) == 0:
-                if len(mnt['filter']) > 0:
-                    res = parser.parse_and_evaluate(mnt['filter'])
-                    logging.info(f"maintenance(): {res}")
-                    return res
-                else:
-                    logging.info(f"maintenance(): True")
+                if len(mnt['filter']) == 0 or compile_filter(mnt['filter']).evaluate(alert):
+                    logging.info(f"maintenance(): True ({mnt['name']})")
                     return True
         except Exception as e:
             logging.error(f"maintenance(): Filter parse error: {mnt['filter']} - {str(e)}")
     logging.info("maintenance(): False")
     return False
 
-# send raw message using specified notification channel
-def send_message(channel_id: int, uri: Any, msg: str):
-    if not isinstance(channel_id, int):
-        logging.error("send_message(): channel_id must be an integer")
-        return None
-    result = []
-    if channel_id == NotifyChannel.TELEGRAM:
-        if not isinstance(uri, int):
-            logging.error("send_message(): telegram ID must be a number")
-            return None
+DIGEST_FLUSH_ON = tuple(getattr(config, 'DIGEST_FLUSH_ON', ("critical",)))
+
+CHANNEL_NAMES = {
+    NotifyChannel.TELEGRAM: "Telegram",
+    NotifyChannel.NTFY: "Ntfy",
+    NotifyChannel.APPRISE: "Apprise",
+}
+
+RATE_LIMIT = getattr(config, 'RATE_LIMIT', True)
+RATE_LIMIT_RETRIES = getattr(config, 'RATE_LIMIT_RETRIES', 2)
+NOTIFY_FANOUT_WORKERS = getattr(config, 'NOTIFY_FANOUT_WORKERS', 16)
+NOTIFY_DEADLINE = getattr(config, 'NOTIFY_DEADLINE', 30)
+
+limiter = None
+deferred_sends = None
+if RATE_LIMIT:
+    limiter = RateLimiter(getattr(config, 'RATE_LIMIT_CHANNEL', {"telegram": 30}),
+                          getattr(config, 'RATE_LIMIT_DESTINATION', {"telegram": 1}),
+                          getattr(config, 'RATE_LIMIT_MAX_WAIT', 30))
+    # Sent again with a short wait, they are only due once the limiter has a slot
+    deferred_sends = DeferredSends(lambda *args: send_notification(*args, max_wait=1),
+                                   getattr(config, 'RATE_LIMIT_QUEUE_SIZE', 10000))
+
+# Send one rendered notification right away. payload holds message, title,
+# priority and actions; Telegram only uses the message
+def post_notification(channel: int, destination: Any, payload: dict) -> dict:
+    if channel == NotifyChannel.TELEGRAM:
         tg = TelegramNotify(bot_token=config.TELEGRAM_BOT_TOKEN)
-        res = tg.send_raw_message(str(uri), msg)
-        result.append({"channel": channel_id, "ok": res['ok'], "user": uri})
-        if not res['ok']:
-            logging.error(f"send_message(): Error sending Telegram notification to {uri}")
-        else:
-            logging.info(f"send_message(): Notification to {uri} was sent successfully by Telegram")
-    elif channel_id == NotifyChannel.NTFY:
+        return tg.send_raw_message(str(destination), payload['message'])
+    elif channel == NotifyChannel.NTFY:
         ntfy = NtfyNotify(ntfy_token=config.NTFY_ACCESS_TOKEN)
-        res = ntfy.send_raw_message(uri, 3, 'AlertHub Notification', msg)
-        result.append({"channel": channel_id, "ok": res['ok'], "user": uri})
-        if not res['ok']:
-            logging.error(f"send_message(): Error sending Ntfy notification to {uri}")
-        else:
-            logging.info(f"send_message(): Notification to {uri} was sent successfully by Ntfy")
-    elif channel_id == NotifyChannel.APPRISE:
+        return ntfy.send_raw_message(destination, payload.get('priority', 3), payload.get('title'), payload['message'], payload.get('actions'))
+    elif channel == NotifyChannel.APPRISE:
         apobj = AppriseNotify()
-        res = apobj.send_raw_message(uri, 'AlertHub Notification', msg)
-        result.append({"channel": channel_id, "ok": res['ok'], "user": uri})
-        if not res['ok']:
-            logging.error(f"send_message(): Error sending Apprise notification to {uri}")
-        else:
-            logging.info(f"send_message(): Notification to {uri} was sent successfully by Apprise")
+        return apobj.send_raw_message(destination, payload.get('title'), payload['message'])
+    return {"ok": False, "response": f"unsupported channel {channel}"}
+
+# post_notification() within the channel and destination rate limits. Waits for
+# a free slot; if that takes longer than max_wait (RATE_LIMIT_MAX_WAIT) nothing is sent and
+# the result is marked deferred with the time to come back in retry_after.
+# A 429 holds back the destination for the retry_after the service asked for
+# and the send is retried up to retries times.
+def send_notification(channel: int, destination: Any, payload: dict, retries: int = 0, max_wait=None) -> dict:
+    if limiter is None:
+        return post_notification(channel, destination, payload)
+    name = CHANNEL_NAMES.get(channel, str(channel)).lower()
+    while True:
+        retry_after = limiter.acquire(name, destination, max_wait)
+        if retry_after is not None:
+            logging.warning(f"{CHANNEL_NAMES.get(channel)} rate limit: deferring notification to {destination} by {retry_after:.1f}s")
+            return {"ok": False, "response": "rate limited", "retry_after": retry_after, "deferred": True}
+        res = post_notification(channel, destination, payload)
+        retry_after = res.get('retry_after')
+        if retry_after is None:
+            return res
+        limiter.throttle(name, destination, retry_after)
+        if retries <= 0:
+            return res
+        retries -= 1
+
+# Queue the notification in the outbox when there is one, send it in place otherwise
+# (or when the outbox can't store it)
+def deliver(channel, recipient, destination, payload, key, alert_id=None, outbox=None) -> dict:
+    if outbox is not None:
+        if outbox.enqueue(key, alert_id, channel, recipient, destination, payload):
+            return {"ok": True, "queued": True, "response": "queued"}
+        logging.warning(f"Outbox unavailable, sending {CHANNEL_NAMES.get(channel)} notification to {recipient} directly")
+    res = send_notification(channel, destination, payload, RATE_LIMIT_RETRIES)
+    if res.get('deferred'):
+        # Over the rate limit for longer than RATE_LIMIT_MAX_WAIT, send it later
+        if deferred_sends.schedule(res['retry_after'], channel, destination, payload, RATE_LIMIT_RETRIES):
+            return {"ok": True, "queued": True, "response": "deferred by the rate limit"}
+        logging.error(f"Rate limit queue is full, dropping {CHANNEL_NAMES.get(channel)} notification to {recipient}")
+    return res
+
+def log_delivery(prefix, channel, recipient, res):
+    name = CHANNEL_NAMES.get(channel)
+    if not res['ok']:
+        logging.error(f"{prefix}Error sending {name} notification to {recipient}")
+    elif res.get('queued'):
+        logging.info(f"{prefix}Notification to {recipient} was queued for delivery by {name}")
+    else:
+        logging.info(f"{prefix}Notification to {recipient} was sent successfully by {name}")
 
-    return result
+# send raw message using specified notification channel
+def send_message(channel_id: int, uri: Any, msg: str, __context__=None, __outbox__=None):
+    if not isinstance(channel_id, int):
+        logging.error("send_message(): channel_id must be an integer")
+        return None
+    if channel_id not in CHANNEL_NAMES:
+        return []
+    if channel_id == NotifyChannel.TELEGRAM and not isinstance(uri, int):
+        logging.error("send_message(): telegram ID must be a number")
+        return None
 
-def notify(telegram_template=0, ntfy_template=0, apprise_template=0, __context__=None, __db__=None):
+    payload = {"title": 'AlertHub Notification', "message": msg, "priority": 3}
+    alert = (__context__ or {}).get('alert')
+    if isinstance(alert, dict):
+        key = NotificationOutbox.idempotency_key(alert, uri, channel_id, hashlib.sha1(str(msg).encode('utf-8')).hexdigest()[:16])
+        alert_id = alert.get('alert_id')
+    else:
+        # Not tied to an alert event, nothing to deduplicate against
+        key = f"message:{uuid.uuid4().hex}"
+        alert_id = None
+    res = deliver(channel_id, uri, uri, payload, key, alert_id, __outbox__)
+    log_delivery("send_message(): ", channel_id, uri, res)
+    return [{"channel": channel_id, "ok": res['ok'], "user": uri}]
+
+def notify(telegram_template=0, ntfy_template=0, apprise_template=0, __context__=None, __templates__=None, __outbox__=None):
     #logging.debug(f"DSL context: {__context__}")
     alert = __context__.get('alert', None)
     if alert is None:
@@ -389,30 +516,22 @@ def notify(telegram_template=0, ntfy_template=0, apprise_template=0, __context__
 
     if 'templates' not in __context__:
         __context__['templates'] = {}
-
-    if telegram_template != 0 and isinstance(telegram_template, int):
-        res = __db__.getTemplate(telegram_template)
-        if res is not None:
-            tpl = res[3]
-            __context__['templates']['telegram'] = tpl
-        else:
-            logging.warning(f"notify(): Error loading telegram_template ID {telegram_template}")
-
-    if ntfy_template != 0 and isinstance(ntfy_template, int):
-        res = __db__.getTemplate(ntfy_template)
-        if res is not None:
-            tpl = res[3]
-            __context__['templates']['ntfy'] = tpl
-        else:
-            logging.warning(f"notify(): Error loading ntfy_template ID {ntfy_template}")
-
-    if apprise_template != 0 and isinstance(apprise_template, int):
-        res = __db__.getTemplate(apprise_template)
-        if res is not None:
-            tpl = res[3]
-            __context__['templates']['apprise'] = tpl
+    # channel -> template id, lets the renderer drop compiled templates on update
+    template_ids = {}
+
+    requested = {
+        channel: tid
+        for channel, tid in (("telegram", telegram_template), ("ntfy", ntfy_template), ("apprise", apprise_template))
+        if tid != 0 and isinstance(tid, int)
+    }
+    loaded = __templates__.get_many(requested.values()) if requested else {}
+    for channel, tid in requested.items():
+        tpl = loaded.get(tid)
+        if tpl is not None:
+            __context__['templates'][channel] = tpl
+            template_ids[channel] = tid
         else:
-            logging.warning(f"notify(): Error loading apprise_template ID {apprise_template}")
+            logging.warning(f"notify(): Error loading {channel}_template ID {tid}")
 
     templates = __context__.get('templates', None)
     if templates is None:
@@ -427,103 +546,170 @@ def notify(telegram_template=0, ntfy_template=0, apprise_template=0, __context__
     if people is None or len(people) <= 0:
         logging.info("Nobody to notify. Skipping..")
         return None
+    jobs = []
+    alert_tmp = None
+    for person, notify_channel, destination in notification_targets(people):
+        channel_name = CHANNEL_NAMES[notify_channel]
+        logging.info(f"Notify user {person['name']} by {channel_name}. Alert id: {alert['alert_id']}, status: {alert['status']}")
+        if alert_tmp is None:
+            alert_tmp = format_alert_times(alert)
+            if alert_tmp is None:
+                return None
+
+        key = channel_name.lower()
+        payload = {
+            "title": alert.get('alertname','-'),
+            "message": render_template(templates.get(key), alert_tmp, template_ids.get(key)),
+            "priority": 3,
+        }
+        if notify_channel == NotifyChannel.NTFY:
+            if alert.get('status', None) == 'firing' and alert.get('severity', None) == 'critical':
+                payload["priority"] = 5
+            payload["actions"] = NtfyNotify.alert_actions(alert)
+
+        jobs.append((notify_channel, person['name'], destination, payload,
+                     NotificationOutbox.idempotency_key(alert, person['name'], notify_channel),
+                     alert['alert_id'], __outbox__))
+
+    return deliver_all(jobs)
+
+# Deliver the notifications of one alert concurrently on the shared fan-out
+# pool, results in the same order as jobs. Whatever is not done by
+# NOTIFY_DEADLINE is reported as failed (and finishes in the background).
+def deliver_all(jobs):
+    if len(jobs) == 1:
+        responses = [deliver(*jobs[0])]
+    else:
+        futures = [fanout_executor().submit(deliver, *job) for job in jobs]
+        wait(futures, timeout=NOTIFY_DEADLINE)
+        responses = []
+        for job, future in zip(jobs, futures):
+            if future.done():
+                try:
+                    responses.append(future.result())
+                except Exception as e:
+                    responses.append({"ok": False, "response": str(e)})
+            else:
+                logging.error(f"Notification to {job[1]} by {CHANNEL_NAMES.get(job[0])} not done within {NOTIFY_DEADLINE}s")
+                responses.append({"ok": False, "response": "deadline exceeded"})
+
     results = []
+    for job, res in zip(jobs, responses):
+        channel, recipient = job[0], job[1]
+        results.append({"channel": channel, "ok": res['ok'], "user": recipient})
+        log_delivery("", channel, recipient, res)
+    return results
+
+fanout_pool = None
+fanout_pool_lock = threading.Lock()
+
+def fanout_executor():
+    global fanout_pool
+    if fanout_pool is None:
+        with fanout_pool_lock:
+            if fanout_pool is None:
+                fanout_pool = ThreadPoolExecutor(max_workers=NOTIFY_FANOUT_WORKERS, thread_name_prefix="notify")
+    return fanout_pool
+
+# (person, channel, destination) for every usable notifier of the on-call people
+def notification_targets(people):
     for person in people:
         for notify_channel in person['notifiers']:
             if notify_channel == NotifyChannel.NONE:
                 logging.info(f"No notification channels defined for {person['name']}. Skip notify..")
                 continue
             if notify_channel == NotifyChannel.TELEGRAM:
-                tpl = templates.get('telegram')
-                tg = TelegramNotify(bot_token=config.TELEGRAM_BOT_TOKEN)
-                chat_id = person['telegram_id']
-                if chat_id and len(chat_id) > 6:
-                    logging.info(f"Notify user {person['name']} by Telegram. Alert id: {alert['alert_id']}, status: {alert['status']}")
-                    alert_tmp = alert.copy()
-                    starts_at = alert_tmp.get('startsAt',None)
-                    ends_at = alert_tmp.get('endsAt',None)
-                    updated_at = alert_tmp.get('updatedAt',None)
-                    if starts_at is None or ends_at is None:
-                        return None
-                    dt_start = datetime.fromtimestamp(starts_at, tz=TZ)
-                    dt_end = datetime.fromtimestamp(ends_at, tz=TZ)
-                    alert_tmp['startsAt'] = format_with_month(dt_start)
-                    alert_tmp['endsAt'] = format_with_month(dt_end)
-                    if updated_at is not None:
-                        dt_updated = datetime.fromtimestamp(updated_at, tz=TZ)
-                        alert_tmp['updatedAt'] = format_with_month(dt_updated)
-                    res = tg.send_alert(chat_id, tpl, alert_tmp)
-                    results.append({"channel": notify_channel, "ok": res['ok'], "user": person['name']})
-                    if not res['ok']:
-                        logging.error(f"Error sending Telegram notification to {person['name']}")
-                    else:
-                        logging.info(f"Notification to {person['name']} was sent successfully by Telegram")
-                    #logging.debug("Telegram API response: %s", res)
-                else:
+                destination = person['telegram_id']
+                if not (destination and len(destination) > 6):
                     logging.error(f"No telegram ID (chat_id) for {person['name']} or it's wrong. Skip notify..")
+                    continue
             elif notify_channel == NotifyChannel.NTFY:
-                tpl = templates.get('ntfy')
-                ntfy = NtfyNotify(ntfy_token=config.NTFY_ACCESS_TOKEN)
-                topic = person['ntfy']
-                if topic and len(topic) > 3:
-                    logging.info(f"Notify user {person['name']} by Ntfy. Alert id: {alert['alert_id']}, status: {alert['status']}")
-                    alert_tmp = alert.copy()
-                    starts_at = alert_tmp.get('startsAt',None)
-                    ends_at = alert_tmp.get('endsAt',None)
-                    updated_at = alert_tmp.get('updatedAt',None)
-                    if starts_at is None or ends_at is None:
-                        return None
-                    dt_start = datetime.fromtimestamp(starts_at, tz=TZ)
-                    dt_end = datetime.fromtimestamp(ends_at, tz=TZ)
-                    alert_tmp['startsAt'] = format_with_month(dt_start)
-                    alert_tmp['endsAt'] = format_with_month(dt_end)
-                    if updated_at is not None:
-                        dt_updated = datetime.fromtimestamp(updated_at, tz=TZ)
-                        alert_tmp['updatedAt'] = format_with_month(dt_updated)
-                    priority = 3
-                    if alert.get('status', None) == 'firing' and alert.get('severity', None) == 'critical':
-                        priority = 5
-                    title = alert.get('alertname','-')
-                    res = ntfy.send_alert(topic, priority, title, tpl, alert_tmp)
-                    results.append({"channel": notify_channel, "ok": res['ok'], "user": person['name']})
-                    if not res['ok']:
-                        logging.error(f"Error sending Ntfy notification to {person['name']}")
-                    else:
-                        logging.info(f"Notification to {person['name']} was sent successfully by Ntfy")
-                    #logging.debug("Ntfy API response: %s", res)
-                else:
+                destination = person['ntfy']
+                if not (destination and len(destination) > 3):
                     logging.error(f"No ntfy topic for {person['name']} or it's wrong. Skip notify..")
+                    continue
             elif notify_channel == NotifyChannel.APPRISE:
-                tpl = templates.get('apprise')
-                apobj = AppriseNotify()
-                apprise_uri = person['apprise']
-                if apprise_uri and len(apprise_uri) > 6:
-                    logging.info(f"Notify user {person['name']} by Apprise. Alert id: {alert['alert_id']}, status: {alert['status']}")
-                    alert_tmp = alert.copy()
-                    starts_at = alert_tmp.get('startsAt',None)
-                    ends_at = alert_tmp.get('endsAt',None)
-                    updated_at = alert_tmp.get('updatedAt',None)
-                    if starts_at is None or ends_at is None:
-                        return None
-                    dt_start = datetime.fromtimestamp(starts_at, tz=TZ)
-                    dt_end = datetime.fromtimestamp(ends_at, tz=TZ)
-                    alert_tmp['startsAt'] = format_with_month(dt_start)
-                    alert_tmp['endsAt'] = format_with_month(dt_end)
-                    if updated_at is not None:
-                        dt_updated = datetime.fromtimestamp(updated_at, tz=TZ)
-                        alert_tmp['updatedAt'] = format_with_month(dt_updated)
-                    title = alert.get('alertname','-')
-                    res = apobj.send_alert(apprise_uri, title, tpl, alert_tmp)
-                    results.append({"channel": notify_channel, "ok": res['ok'], "user": person['name']})
-                    if not res['ok']:
-                        logging.error(f"Error sending Apprise notification to {person['name']}")
-                    else:
-                        logging.info(f"Notification to {person['name']} was sent successfully by Appris")
-                else:
+                destination = person['apprise']
+                if not (destination and len(destination) > 6):
                     logging.error(f"No apprise uri for {person['name']} or it's wrong. Skip notify..")
+                    continue
+            else:
+                continue
+            yield person, notify_channel, destination
+
+# Coalesce the alert into per recipient and channel digests instead of sending
+# it right away. Templates are digest templates (rendered with alerts and count),
+# they default to the pipeline's digest: options and then to a built-in list.
+# Alerts with a severity in flush_on send the pending digest immediately.
+def digest(telegram_template=0, ntfy_template=0, apprise_template=0, window=None,
+           __context__=None, __templates__=None, __digest__=None, __options__=None, __outbox__=None):
+    if __digest__ is None:
+        logging.warning("digest(): digests are not available, notifying directly")
+        return notify(__context__=__context__, __templates__=__templates__, __outbox__=__outbox__)
+    alert = __context__.get('alert', None)
+    if not isinstance(alert, dict):
+        logging.error("digest(): No alert in context")
+        return None
+    options = __options__ or {}
+    if window is None:
+        window = options.get('window')
+
+    templates = dict(options.get('templates') or {})
+    requested = {
+        channel: tid
+        for channel, tid in (("telegram", telegram_template), ("ntfy", ntfy_template), ("apprise", apprise_template))
+        if tid != 0 and isinstance(tid, int)
+    }
+    templates.update(requested)
+    ids = [tid for tid in templates.values() if isinstance(tid, int)]
+    loaded = __templates__.get_many(ids) if ids else {}
 
+    schedule = __context__.get('schedule', None)
+    if schedule is None:
+        logging.warning("digest(): No active schedule found. Skip..")
+        return None
+    people = schedule.get('people', None)
+    if people is None or len(people) <= 0:
+        logging.info("digest(): Nobody to notify. Skipping..")
+        return None
+
+    alert_tmp = format_alert_times(alert)
+    if alert_tmp is None:
+        return None
+    flush = alert.get('status') == 'firing' and alert.get('severity') in options.get('flush_on', DIGEST_FLUSH_ON)
+    results = []
+    for person, notify_channel, destination in notification_targets(people):
+        tpl = templates.get(CHANNEL_NAMES[notify_channel].lower())
+        tid = None
+        if isinstance(tpl, int):
+            tid = tpl
+            tpl = loaded.get(tid)
+            if tpl is None:
+                logging.warning(f"digest(): Error loading template ID {tid}, using the default")
+                tid = None
+        res = __digest__.add(notify_channel, person['name'], destination, alert_tmp, tpl, tid, window, flush)
+        logging.info(f"digest(): Alert {alert['alert_id']} added to {CHANNEL_NAMES[notify_channel]} digest for {person['name']}{', sent' if res is not None else ''}")
+        # A digest sent right away reports how that went (DigestBuffer.send logs errors)
+        results.append({"channel": notify_channel, "ok": res is None or res['ok'], "user": person['name'], "digest": True})
     return results
 
+# Copy of the alert with human readable timestamps for templates, None if they are missing
+def format_alert_times(alert: dict):
+    alert_tmp = alert.copy()
+    starts_at = alert_tmp.get('startsAt',None)
+    ends_at = alert_tmp.get('endsAt',None)
+    updated_at = alert_tmp.get('updatedAt',None)
+    if starts_at is None or ends_at is None:
+        return None
+    dt_start = datetime.fromtimestamp(starts_at, tz=TZ)
+    dt_end = datetime.fromtimestamp(ends_at, tz=TZ)
+    alert_tmp['startsAt'] = format_with_month(dt_start)
+    alert_tmp['endsAt'] = format_with_month(dt_end)
+    if updated_at is not None:
+        dt_updated = datetime.fromtimestamp(updated_at, tz=TZ)
+        alert_tmp['updatedAt'] = format_with_month(dt_updated)
+    return alert_tmp
+
 def format_with_month(dt: datetime) -> str:
     offset = dt.strftime("%z")
     offset = offset[:3] + ":" + offset[3:]
@@ -1,22 +1,16 @@
 import logging
 import requests
-import jinja2
 from requests.exceptions import RequestException
+from utils.render import render_template
 import config
 import apprise
 
 class AppriseNotify:
     def __init__(self):
         self.ap_h = apprise.Apprise()
-        self.env = jinja2.Environment(
-            autoescape=False,
-            trim_blocks=False,
-            lstrip_blocks=False
-        )
 
-    def render_message(self, template: str, context: dict) -> str:
-        tpl = self.env.from_string(template)
-        return tpl.render(context)
+    def render_message(self, template: str, context: dict, template_id=None) -> str:
+        return render_template(template, context, template_id)
 
     def send_raw_message(self, uri: str, title: str, msg: str):
         self.ap_h.add(uri)
@@ -37,6 +31,6 @@ class AppriseNotify:
             logging.error("Apprise send_message_alert failed: %s", e)
             return {"ok": False, "response": str(e)}
 
-    def send_alert(self, uri: str, title: str, template: str, alert: dict):
-        msg = self.render_message(template, alert)
-        self.send_raw_message(uri, title, msg)
+    def send_alert(self, uri: str, title: str, template: str, alert: dict, template_id=None):
+        msg = self.render_message(template, alert, template_id)
+        return self.send_raw_message(uri, title, msg)
@@ -0,0 +1,150 @@
+import threading
+import random
+import time
+import logging
+from collections import OrderedDict
+
+# name -> cache with a stats() method, for the stats endpoint
+caches = {}
+caches_lock = threading.Lock()
+
+class CacheEntry:
+    __slots__ = ("value", "expires", "stale_until")
+
+    def __init__(self, value, expires, stale_until):
+        self.value = value
+        self.expires = expires
+        self.stale_until = stale_until
+
+# Bounded LRU cache with per-entry TTL.
+# - TTLs get a random jitter so entries loaded together don't expire together
+# - only one thread loads a missing key, the others wait for its result
+# - an expired entry is served stale for up to stale_ttl seconds while a
+#   single thread reloads it; a failed reload keeps serving the stale value
+# - invalidate()/clear() drop entries right away
+class Cache:
+    def __init__(self, name, maxsize=1024, ttl=15, stale_ttl=None, jitter=0.1):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = ttl if stale_ttl is None else stale_ttl
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # key -> Event set when the in-flight load finishes
+        self.loading = {}
+        # bumped by invalidate/clear so in-flight loads don't store outdated values
+        self.generation = 0
+        self.counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+        register_cache(name, self)
+
+    def get(self, key, loader, default=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if now < entry.expires:
+                        self.entries.move_to_end(key)
+                        self.counters["hits"] += 1
+                        return entry.value
+                    if now >= entry.stale_until:
+                        del self.entries[key]
+                        self.counters["expirations"] += 1
+                        entry = None
+                event = self.loading.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.loading[key] = event
+                    generation = self.generation
+                    if entry is None:
+                        self.counters["misses"] += 1
+                    else:
+                        self.counters["stale_hits"] += 1
+                    break
+                if entry is not None:
+                    self.counters["stale_hits"] += 1
+                    return entry.value
+            # Someone else is loading this key
+            event.wait()
+
+        try:
+            value = loader()
+        except Exception as e:
+            logging.error(f"Cache {self.name}: loading {key} failed: {e}")
+            with self.lock:
+                self.counters["load_errors"] += 1
+            return entry.value if entry is not None else default
+        else:
+            self.set(key, value, generation)
+            return value
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+            event.set()
+
+    # (True, value) for a fresh entry, (False, None) otherwise. For callers
+    # that load several missing keys at once and store them with set()
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() < entry.expires:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return True, entry.value
+            self.counters["misses"] += 1
+            return False, None
+
+    def set(self, key, value, generation=None):
+        ttl = self.ttl * (1 + random.uniform(0, self.jitter))
+        now = time.monotonic()
+        with self.lock:
+            self.counters["loads"] += 1
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = CacheEntry(value, now + ttl, now + ttl + self.stale_ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            if self.entries.pop(key, None) is not None:
+                self.counters["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.counters["invalidations"] += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "loading": len(self.loading),
+                **self.counters,
+            }
+
+# Anything with a stats() method can show up in cache_stats()
+def register_cache(name, cache):
+    with caches_lock:
+        caches[name] = cache
+
+def cache_stats():
+    with caches_lock:
+        return {name: cache.stats() for name, cache in caches.items()}
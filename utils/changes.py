@@ -0,0 +1,94 @@
+import json
+import select
+import threading
+import logging
+import psycopg2
+import psycopg2.extensions
+
+# Listens for the change notifications AlertsDatabase.notifyChange() sends
+# from every AlertHub instance sharing the database and hands them over to
+# handler(entity, key). Our own notifications (same origin) are skipped, the
+# API endpoints already invalidated what they changed. Notifications sent
+# while the listener was disconnected are lost, so after a reconnect
+# handler("all", None) is called to drop everything.
+class ChangeListener:
+    def __init__(self, dsn, channel, handler, origin=None, poll_interval=10, reconnect_interval=5):
+        self.dsn = dsn
+        self.channel = channel
+        self.handler = handler
+        self.origin = origin
+        self.poll_interval = poll_interval
+        self.reconnect_interval = reconnect_interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.connected = False
+        self.counters = {
+            "received": 0,
+            "applied": 0,
+            "errors": 0,
+            "reconnects": 0,
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.listener, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(self.poll_interval + 1)
+
+    def listener(self):
+        connected_before = False
+        while not self.stop_event.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {self.channel}")
+                self.connected = True
+                logging.info(f"Change listener: listening on {self.channel}")
+                if connected_before:
+                    self.counters["reconnects"] += 1
+                    self.dispatch("all", None)
+                connected_before = True
+
+                while not self.stop_event.is_set():
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        # Idle, make sure the connection is still alive
+                        cursor.execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.receive(conn.notifies.pop(0).payload)
+            except (Exception, psycopg2.DatabaseError) as e:
+                logging.error(f"Change listener error: {e}")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.closed:
+                    conn.close()
+            self.stop_event.wait(self.reconnect_interval)
+
+    def receive(self, payload):
+        self.counters["received"] += 1
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            logging.error(f"Change listener: malformed payload {payload}")
+            return
+        if self.origin is not None and change.get("origin") == self.origin:
+            return
+        self.dispatch(change.get("entity"), change.get("id"))
+
+    def dispatch(self, entity, key):
+        logging.debug(f"Change listener: {entity} {key} changed")
+        try:
+            self.handler(entity, key)
+            self.counters["applied"] += 1
+        except Exception as e:
+            self.counters["errors"] += 1
+            logging.error(f"Change listener: handler failed for {entity} {key}: {e}")
+
+    def stats(self):
+        return {"connected": self.connected, **self.counters}
@@ -0,0 +1,122 @@
+import threading
+import time
+import uuid
+import logging
+from utils.render import render_template
+
+DEFAULT_TEMPLATE = """*{{ count }} alerts*
+{% for a in alerts %}- [{{ a.status }}] {{ a.alertname }} ({{ a.severity }}) {{ a.startsAt }}
+{% endfor %}"""
+
+class DigestEntry:
+    __slots__ = ("channel", "recipient", "destination", "template", "template_id", "alerts", "flush_at")
+
+    def __init__(self, channel, recipient, destination, template, template_id, flush_at):
+        self.channel = channel
+        self.recipient = recipient
+        self.destination = destination
+        self.template = template
+        self.template_id = template_id
+        self.alerts = []
+        self.flush_at = flush_at
+
+# Coalesces notifications per channel and destination. The first alert opens a
+# window, alerts arriving within it are added to the same digest, which is
+# rendered and handed to sender(channel, recipient, destination, payload, key)
+# once the window is over. An alert with a flush severity (or a full digest)
+# sends the digest right away.
+class DigestBuffer:
+    def __init__(self, sender, window=60, max_alerts=100, flush_interval=1.0):
+        self.sender = sender
+        self.window = window
+        self.max_alerts = max_alerts
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.thread_timeout = 20
+        self.counters = {
+            "alerts": 0,
+            "digests": 0,
+            "early_flushes": 0,
+            "errors": 0,
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.flusher, daemon=True)
+        self.thread.start()
+
+    # Pending digests are sent on stop rather than lost
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(self.thread_timeout)
+        self.flush(force=True)
+
+    # alert is the template ready copy (see format_alert_times). Returns the send
+    # result if the digest was sent right away, None while it is buffered
+    def add(self, channel, recipient, destination, alert, template=None, template_id=None,
+            window=None, flush=False):
+        if window is None:
+            window = self.window
+        key = (channel, str(destination), template_id if template_id is not None else template)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = DigestEntry(channel, recipient, destination, template, template_id, time.monotonic() + window)
+                self.entries[key] = entry
+            entry.alerts.append(alert)
+            self.counters["alerts"] += 1
+            if not flush and len(entry.alerts) < self.max_alerts:
+                return None
+            del self.entries[key]
+            self.counters["early_flushes"] += 1
+        return self.send(entry)
+
+    def flusher(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Digest flush error: {e}")
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        with self.lock:
+            due = [key for key, entry in self.entries.items() if force or entry.flush_at <= now]
+            entries = [self.entries.pop(key) for key in due]
+        for entry in entries:
+            self.send(entry)
+
+    def send(self, entry):
+        alerts = entry.alerts
+        context = {"alerts": alerts, "count": len(alerts)}
+        critical = any(a.get('status') == 'firing' and a.get('severity') == 'critical' for a in alerts)
+        payload = {
+            "title": alerts[0].get('alertname', '-') if len(alerts) == 1 else f"AlertHub: {len(alerts)} alerts",
+            "message": render_template(entry.template or DEFAULT_TEMPLATE, context, entry.template_id),
+            "priority": 5 if critical else 3,
+        }
+        key = f"digest:{entry.channel}:{entry.destination}:{uuid.uuid4().hex}"
+        try:
+            res = self.sender(entry.channel, entry.recipient, entry.destination, payload, key)
+        except Exception as e:
+            res = {"ok": False, "response": str(e)}
+        with self.lock:
+            self.counters["digests"] += 1
+            if not res['ok']:
+                self.counters["errors"] += 1
+        if res['ok']:
+            logging.info(f"Digest of {len(alerts)} alerts sent to {entry.recipient}")
+        else:
+            logging.error(f"Error sending digest of {len(alerts)} alerts to {entry.recipient}")
+        return res
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.entries),
+                "pending_alerts": sum(len(e.alerts) for e in self.entries.values()),
+                **self.counters,
+            }
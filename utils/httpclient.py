@@ -0,0 +1,42 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import config
+
+# Never below the number of threads that can send at once (notify() fan-out and
+# outbox workers), otherwise urllib3 discards connections ("Connection pool is full")
+HTTP_POOL_SIZE = max(getattr(config, 'HTTP_POOL_SIZE', 10),
+                     getattr(config, 'NOTIFY_FANOUT_WORKERS', 16) + getattr(config, 'OUTBOX_WORKERS', 4))
+HTTP_CONNECT_TIMEOUT = getattr(config, 'HTTP_CONNECT_TIMEOUT', 5)
+HTTP_READ_TIMEOUT = getattr(config, 'HTTP_READ_TIMEOUT', 10)
+
+# Long-lived requests sessions, one per notification service, so deliveries
+# reuse keep-alive connections instead of doing a TCP+TLS handshake per message.
+# Each session keeps up to HTTP_POOL_SIZE connections per host, one per
+# thread sending at the same time.
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_session(name: str) -> requests.Session:
+    session = sessions.get(name)
+    if session is not None:
+        return session
+    with sessions_lock:
+        session = sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            sessions[name] = session
+    return session
+
+def post(name: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session(name).post(url, **kwargs)
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
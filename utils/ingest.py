@@ -0,0 +1,114 @@
+import threading
+import queue
+import time
+import logging
+from utils.spool import SPOOLED
+
+# Bounded in-process queue between the Alertmanager webhook and the database.
+# Webhook payloads are acknowledged as soon as they are queued, ingest workers
+# store them with store_handler() and hand the results over to on_alerts().
+# store_handler() returns the stored alerts, SPOOLED if the payload went to the
+# disk spool (it's dispatched on replay) or None if the payload was lost.
+# Every worker has its own FIFO and payloads go to the worker of their group key
+# (the first alert's fingerprint without one), so updates of the same alerts are
+# stored and dispatched in the order they arrived.
+class AlertIngest:
+    def __init__(self, store_handler, on_alerts, num_workers=2, queue_size=1000):
+        self.store = store_handler
+        self.on_alerts = on_alerts
+        self.num_workers = max(1, num_workers)
+        self.threads = []
+        self.thread_timeout = 20
+        self.queue_size = queue_size
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // self.num_workers)) for _ in range(self.num_workers)]
+        self.stats_lock = threading.Lock()
+        self.counters = {
+            "enqueued": 0,
+            "rejected": 0,
+            "committed": 0,
+            "spooled": 0,
+            "failed": 0,
+            "alerts": 0,
+        }
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    def start(self):
+        for task_queue in self.queues:
+            t = threading.Thread(target=self.worker, args=(task_queue,), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        for task_queue in self.queues:
+            task_queue.put(None)
+        for task_queue in self.queues:
+            task_queue.join()
+        for t in self.threads:
+            t.join(self.thread_timeout)
+
+    def route(self, alerts, group_key):
+        key = group_key
+        if key is None and alerts and isinstance(alerts[0], dict):
+            key = alerts[0].get('fingerprint')
+        return self.queues[hash(key) % self.num_workers]
+
+    # Returns False when the queue is full and the caller should back off
+    def submit(self, alerts, group_key=None):
+        try:
+            self.route(alerts, group_key).put_nowait((time.monotonic(), alerts, group_key))
+        except queue.Full:
+            with self.stats_lock:
+                self.counters["rejected"] += 1
+            return False
+        with self.stats_lock:
+            self.counters["enqueued"] += 1
+        return True
+
+    def worker(self, task_queue):
+        while True:
+            task = task_queue.get()
+            if task is None:
+                task_queue.task_done()
+                break
+            try:
+                self.ingest(*task)
+            except Exception as e:
+                logging.error(f"Alert ingest failed: {e}")
+            finally:
+                task_queue.task_done()
+
+    def ingest(self, enqueued_at, alerts, group_key=None):
+        results = self.store(alerts)
+        latency = time.monotonic() - enqueued_at
+        with self.stats_lock:
+            if results is None:
+                self.counters["failed"] += 1
+            elif results is SPOOLED:
+                self.counters["spooled"] += 1
+            else:
+                self.counters["committed"] += 1
+                self.counters["alerts"] += len(alerts)
+                self.latency_total += latency
+                self.latency_last = latency
+                self.latency_max = max(self.latency_max, latency)
+        if results is None:
+            logging.error(f"Alert ingest: batch of {len(alerts)} alerts was not stored")
+            return
+        if results is SPOOLED:
+            return
+        self.on_alerts(results, group_key)
+
+    def stats(self):
+        with self.stats_lock:
+            committed = self.counters["committed"]
+            return {
+                "queue_depth": sum(task_queue.qsize() for task_queue in self.queues),
+                "queue_size": self.queue_size,
+                "workers": self.num_workers,
+                **self.counters,
+                "latency_avg_ms": round(self.latency_total / committed * 1000, 2) if committed else 0,
+                "latency_max_ms": round(self.latency_max * 1000, 2),
+                "latency_last_ms": round(self.latency_last * 1000, 2),
+            }
@@ -0,0 +1,329 @@
+import threading
+import operator
+import time
+import logging
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import config
+
+TZ = ZoneInfo(config.TZ)
+
+# Maintenance filters ("labels.env == 'prod' & (labels.job == node || labels.job == db)")
+# compiled once into a tree of predicates. Evaluation follows the original
+# FilterParser rules exactly: every part of an || / & list is evaluated,
+# parentheses are not quote-aware and numeric literals are coerced the same way.
+
+OPERATORS = (
+    ('==', operator.eq),
+    ('!=', operator.ne),
+    ('>=', operator.ge),
+    ('<=', operator.le),
+    ('>', operator.gt),
+    ('<', operator.lt),
+)
+
+def is_number(value):
+    return value.replace('.', '').replace('-', '').isdigit()
+
+# Split on a top level operator, skipping over parenthesized groups
+def split_by_operator(expression, op):
+    parts = []
+    start = 0
+    i = 0
+    size = len(expression)
+    while i < size:
+        if expression[i] == '(':
+            depth = 1
+            i += 1
+            while i < size and depth > 0:
+                if expression[i] == '(':
+                    depth += 1
+                elif expression[i] == ')':
+                    depth -= 1
+                i += 1
+        elif expression.startswith(op, i):
+            parts.append(expression[start:i].strip())
+            i += len(op)
+            start = i
+        else:
+            i += 1
+    parts.append(expression[start:].strip())
+    return parts
+
+def is_enclosed(condition):
+    depth = 0
+    last = len(condition) - 2
+    for i, char in enumerate(condition[:-1]):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0 and i != last:
+                return False
+    return True
+
+class FilterGroup:
+    __slots__ = ("parts", "combine")
+
+    def __init__(self, parts, combine):
+        self.parts = parts
+        self.combine = combine
+
+    def evaluate(self, data):
+        return self.combine([part.evaluate(data) for part in self.parts])
+
+class FilterError:
+    __slots__ = ("message",)
+
+    def __init__(self, message):
+        self.message = message
+
+    def evaluate(self, data):
+        raise ValueError(self.message)
+
+class FilterCondition:
+    __slots__ = ("field", "keys", "op", "literal", "kind", "value")
+
+    def __init__(self, field, op, literal):
+        self.field = field
+        self.keys = tuple(field.split('.'))
+        self.op = op
+        self.literal = literal
+        self.kind = "str"
+        self.value = literal
+        try:
+            if literal.isdigit() or (literal.startswith('-') and literal[1:].isdigit()):
+                self.value = int(literal)
+                self.kind = "int"
+            elif is_number(literal):
+                self.value = float(literal)
+                self.kind = "float"
+        except ValueError:
+            self.kind = "str"
+            self.value = literal
+
+    def lookup(self, data):
+        current = data
+        for key in self.keys:
+            if isinstance(current, dict) and key in current:
+                current = current[key]
+            else:
+                raise ValueError(f"Field '{self.field}' not found in alert data")
+        return current
+
+    def evaluate(self, data):
+        left = self.lookup(data)
+        right = self.value
+        if self.kind != "str" and isinstance(left, str):
+            try:
+                if self.kind == "int" and left.isdigit():
+                    left = int(left)
+                elif is_number(left):
+                    left = float(left)
+            except ValueError:
+                right = self.literal
+        return self.op(left, right)
+
+def compile_expression(expression):
+    expression = expression.strip()
+    or_parts = [compile_and(part.strip()) for part in split_by_operator(expression, '||')]
+    if len(or_parts) > 1:
+        return FilterGroup(tuple(or_parts), any)
+    return or_parts[0]
+
+def compile_and(expression):
+    and_parts = [compile_condition(part.strip()) for part in split_by_operator(expression, '&')]
+    if len(and_parts) > 1:
+        return FilterGroup(tuple(and_parts), all)
+    return and_parts[0]
+
+def compile_condition(condition):
+    if condition.startswith('(') and condition.endswith(')') and is_enclosed(condition):
+        return compile_expression(condition[1:-1])
+
+    for token, op in OPERATORS:
+        if token in condition:
+            left, right = condition.split(token, 1)
+            left = left.strip()
+            right = right.strip()
+            if (right.startswith('"') and right.endswith('"')) or \
+               (right.startswith("'") and right.endswith("'")):
+                right = right[1:-1]
+            return FilterCondition(left, op, right)
+    return FilterError(f"Invalid condition: {condition}")
+
+FILTER_CACHE_SIZE = 1024
+filter_cache = {}
+filter_cache_lock = threading.Lock()
+
+# Compiled filter for the given text, shared between all alerts and windows
+def compile_filter(text):
+    compiled = filter_cache.get(text)
+    if compiled is not None:
+        return compiled
+    compiled = compile_expression(text)
+    with filter_cache_lock:
+        if len(filter_cache) >= FILTER_CACHE_SIZE:
+            filter_cache.clear()
+        filter_cache[text] = compiled
+    return compiled
+
+def clear_filter_cache():
+    with filter_cache_lock:
+        filter_cache.clear()
+
+# Equality-only filters ("labels.env == prod & labels.job == node") as a
+# tuple of (field, compiled condition, literal), None for anything else
+def equality_terms(compiled):
+    if isinstance(compiled, FilterCondition):
+        conditions = (compiled,)
+    elif isinstance(compiled, FilterGroup) and compiled.combine is all:
+        conditions = compiled.parts
+    else:
+        return None
+    terms = {}
+    for cond in conditions:
+        if not isinstance(cond, FilterCondition) or cond.op is not operator.eq or cond.kind != "str":
+            return None
+        if terms.setdefault(cond.field, (cond, cond.literal))[1] != cond.literal:
+            return None
+    return tuple((field, cond, literal) for field, (cond, literal) in sorted(terms.items()))
+
+# In-memory index of maintenance windows that have not ended yet.
+# Windows are bucketed by on-call group id (empty oncall_groups go to the
+# global bucket), equality-only filters are looked up by the alert's label
+# values and only the remaining filters are evaluated one by one.
+# Start/end times are checked at lookup, so the index only changes when
+# maintenances are added, updated or deleted.
+class MaintenanceIndex:
+    def __init__(self, tz=TZ):
+        self.tz = tz
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.by_group = {}
+        self.global_ids = set()
+        # fields -> (conditions, {values: {window ids}})
+        self.equality = {}
+        self.generic = {}
+        self.loaded_at = None
+
+    def load(self, rows):
+        with self.lock:
+            self.windows = {}
+            self.by_group = {}
+            self.global_ids = set()
+            self.equality = {}
+            self.generic = {}
+            for row in rows:
+                self.add_locked(row)
+            self.loaded_at = time.time()
+
+    def update(self, row):
+        with self.lock:
+            self.remove_locked(row[0])
+            self.add_locked(row)
+
+    def remove(self, mid):
+        with self.lock:
+            self.remove_locked(mid)
+
+    def add_locked(self, row):
+        mid, name, description, text, groups, starts_at, ends_at = row[:7]
+        groups = groups or []
+        window = {
+            "id": mid,
+            "name": name,
+            "description": description,
+            "filter": text,
+            "oncall_groups": groups,
+            "starts_at": datetime.fromtimestamp(starts_at, tz=self.tz).isoformat(),
+            "ends_at": datetime.fromtimestamp(ends_at, tz=self.tz).isoformat()
+        }
+        terms = None
+        compiled = None
+        if text is None:
+            compiled = FilterError("filter is not set")
+        elif len(text) > 0:
+            compiled = compile_filter(text)
+            terms = equality_terms(compiled)
+        self.windows[mid] = (window, starts_at, ends_at, compiled, terms)
+
+        if len(groups) == 0:
+            self.global_ids.add(mid)
+        for gid in groups:
+            self.by_group.setdefault(gid, set()).add(mid)
+
+        if terms is not None:
+            fields = tuple(field for field, _, _ in terms)
+            values = tuple(literal for _, _, literal in terms)
+            conds = tuple(cond for _, cond, _ in terms)
+            self.equality.setdefault(fields, (conds, {}))[1].setdefault(values, set()).add(mid)
+        else:
+            self.generic[mid] = compiled
+
+    def remove_locked(self, mid):
+        entry = self.windows.pop(mid, None)
+        if entry is None:
+            return
+        window, _, _, _, terms = entry
+        self.global_ids.discard(mid)
+        for gid in window["oncall_groups"]:
+            ids = self.by_group.get(gid)
+            if ids is not None:
+                ids.discard(mid)
+                if not ids:
+                    del self.by_group[gid]
+        if terms is not None:
+            fields = tuple(field for field, _, _ in terms)
+            values = tuple(literal for _, _, literal in terms)
+            buckets = self.equality[fields][1]
+            buckets[values].discard(mid)
+            if not buckets[values]:
+                del buckets[values]
+                if not buckets:
+                    del self.equality[fields]
+        else:
+            del self.generic[mid]
+
+    def is_active(self, mid, now):
+        _, starts_at, ends_at, _, _ = self.windows[mid]
+        return starts_at <= now <= ends_at
+
+    # Windows active at the given time, in the format exposed to pipelines
+    def active(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return [self.windows[mid][0] for mid in sorted(self.windows) if self.is_active(mid, now)]
+
+    # First active window of the on-call group (or global) whose filter matches the alert
+    def match(self, alert, group_id, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            candidates = self.global_ids | self.by_group.get(group_id, set())
+            candidates = {mid for mid in candidates if self.is_active(mid, now)}
+            if not candidates:
+                return None
+
+            for conds, buckets in self.equality.values():
+                try:
+                    ids = buckets.get(tuple(cond.lookup(alert) for cond in conds))
+                except (ValueError, TypeError):
+                    continue
+                if ids:
+                    for mid in sorted(ids & candidates):
+                        return self.windows[mid][0]
+
+            for mid in sorted(candidates):
+                if mid not in self.generic:
+                    continue
+                compiled = self.generic[mid]
+                if compiled is None:
+                    return self.windows[mid][0]
+                try:
+                    if compiled.evaluate(alert):
+                        return self.windows[mid][0]
+                except Exception as e:
+                    logging.error(f"maintenance(): Filter parse error: {self.windows[mid][0]['filter']} - {str(e)}")
+            return None
@@ -1,7 +1,7 @@
 import logging
-import requests
-import jinja2
 from requests.exceptions import RequestException
+from utils.render import render_template
+from utils import httpclient
 import config
 
 class NtfyNotify:
@@ -11,30 +11,31 @@ class NtfyNotify:
         if not ntfy_token:
             raise ValueError("Ntfy access token must be provided")
         self.ntfy_token = ntfy_token
-        self.env = jinja2.Environment(
-            autoescape=False,
-            trim_blocks=False,
-            lstrip_blocks=False
-        )
 
-    def render_message(self, template: str, context: dict) -> str:
-        tpl = self.env.from_string(template)
-        return tpl.render(context)
+    def render_message(self, template: str, context: dict, template_id=None) -> str:
+        return render_template(template, context, template_id)
 
-    def send_raw_message(self, topic: str, priority: int, title: str, msg: str):
+    def send_raw_message(self, topic: str, priority: int, title: str, msg: str, actions: list = None):
         payload = {
             "topic": topic,
             "title": title,
             "message": msg,
             "priority": priority
         }
+        if actions:
+            payload["actions"] = actions
 
         headers = {
             "Authorization": "Bearer " + self.ntfy_token
         }
 
         try:
-            response = requests.post(self.NTFY_SERVER, json=payload, headers=headers, timeout=10)
+            response = httpclient.post("ntfy", self.NTFY_SERVER, json=payload, headers=headers)
+            if response.status_code == 429:
+                retry_after = response.headers.get("Retry-After", "1")
+                retry_after = int(retry_after) if retry_after.isdigit() else 1
+                logging.warning("Ntfy rate limit hit, retry after %ss", retry_after)
+                return {"ok": False, "response": response.text, "retry_after": retry_after}
             response.raise_for_status()
             result = response.json()
 
@@ -48,38 +49,16 @@ class NtfyNotify:
             logging.error("Ntfy send_message failed: %s", e)
             return {"ok": False, "response": str(e)}
 
-    def send_alert(self, topic: str, priority: int, title: str, template: str, alert: dict):
-        msg = self.render_message(template, alert)
+    @staticmethod
+    def alert_actions(alert: dict) -> list:
+        return [
+            {
+            "action": "view",
+            "label": "Open Alert",
+            "url": config.BASE_URL + "/home/alerts/" + alert['alert_id']
+            }
+        ]
 
-        payload = {
-            "topic": topic,
-            "title": title,
-            "message": msg,
-            "priority": priority,
-            "actions": [
-                {
-                "action": "view",
-                "label": "Open Alert",
-                "url": config.BASE_URL + "/home/alerts/" + alert['alert_id']
-                }
-            ]
-        }
-
-        headers = {
-            "Authorization": "Bearer " + self.ntfy_token
-        }
-
-        try:
-            response = requests.post(self.NTFY_SERVER, json=payload, headers=headers, timeout=10)
-            response.raise_for_status()
-            result = response.json()
-
-            if not result.get("id", False):
-                logging.error("Ntfy API error: %s", result)
-                return {"ok": False, "response": result}
-            else:
-                return {"ok": True, "response": result}
-
-        except RequestException as e:
-            logging.error("Ntfy send_message failed: %s", e)
-            return {"ok": False, "response": str(e)}
+    def send_alert(self, topic: str, priority: int, title: str, template: str, alert: dict, template_id=None):
+        msg = self.render_message(template, alert, template_id)
+        return self.send_raw_message(topic, priority, title, msg, self.alert_actions(alert))
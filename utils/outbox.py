@@ -0,0 +1,155 @@
+import threading
+import random
+import time
+import logging
+
+# DB-backed notification outbox. notify()/send_message() only enqueue rendered
+# messages, a separate pool of delivery workers claims due rows with
+# FOR UPDATE SKIP LOCKED (several AlertHub instances can share the table),
+# sends them through sender(channel, destination, payload) and retries
+# failures with exponential backoff until max_attempts, then dead-letters them.
+# Rows are claimed batch_size at a time for lease seconds. Before each send the
+# lease of the rest of the batch is renewed, so rows waiting in a worker's batch
+# aren't claimed and sent again by another worker: lease only has to cover one
+# send. A row that was claimed again anyway is skipped.
+class NotificationOutbox:
+    def __init__(self, db_handler, sender, num_workers=4, batch_size=10, poll_interval=1.0, lease=60,
+                 max_attempts=8, backoff_base=5, backoff_max=900, retention_days=7):
+        self.db = db_handler
+        self.sender = sender
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention = retention_days * 86400
+        self.threads = []
+        self.thread_timeout = 20
+        self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+        self.next_purge = 0.0
+        self.stats_lock = threading.Lock()
+        self.counters = {
+            "enqueued": 0,
+            "duplicates": 0,
+            "sent": 0,
+            "retried": 0,
+            "deferred": 0,
+            "dead": 0,
+            "lease_lost": 0,
+            "errors": 0,
+        }
+
+    def start(self):
+        for _ in range(self.num_workers):
+            t = threading.Thread(target=self.worker, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+        for t in self.threads:
+            t.join(self.thread_timeout)
+
+    def count(self, name, n=1):
+        with self.stats_lock:
+            self.counters[name] += n
+
+    # Same alert event, recipient and channel -> same key. startsAt and
+    # alert_count tell repeated or re-fired notifications apart from replays
+    @staticmethod
+    def idempotency_key(alert, recipient, channel, extra=None):
+        parts = [alert.get('alert_id'), alert.get('status'), alert.get('startsAt'), alert.get('alert_count'), recipient, int(channel)]
+        if extra is not None:
+            parts.append(extra)
+        return ":".join(str(p) for p in parts)
+
+    # True if the message is queued (now or by an earlier run), False if it could not be stored
+    def enqueue(self, key, alert_id, channel, recipient, destination, payload):
+        nid = self.db.enqueueNotification(key, alert_id, int(channel), str(recipient), str(destination), payload)
+        if nid is False:
+            return False
+        if nid is None:
+            logging.info(f"Outbox: {key} already queued, skipping")
+            self.count("duplicates")
+        else:
+            self.count("enqueued")
+            self.wakeup.set()
+        return True
+
+    def backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            try:
+                jobs = self.db.claimNotifications(self.batch_size, self.lease)
+                if jobs is False:
+                    jobs = []
+                for i, job in enumerate(jobs):
+                    # jobs are (nid, ..., attempts)
+                    renewed = self.db.renewNotifications([(j[0], j[-1]) for j in jobs[i:]], self.lease)
+                    if job[0] not in renewed:
+                        logging.warning(f"Outbox: lease of notification {job[0]} lost, skipping")
+                        self.count("lease_lost")
+                        continue
+                    self.deliver(*job)
+                self.purge()
+            except Exception as e:
+                logging.error(f"Outbox worker error: {e}")
+                jobs = []
+            if len(jobs) < self.batch_size:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+    def deliver(self, nid, alert_id, channel, recipient, destination, payload, attempts):
+        try:
+            res = self.sender(channel, destination, payload)
+        except Exception as e:
+            res = {"ok": False, "response": str(e)}
+
+        if res is not None and res.get('ok'):
+            self.db.completeNotification(nid, "sent")
+            self.count("sent")
+            logging.info(f"Outbox: notification {nid} to {recipient} delivered (attempt {attempts})")
+            return
+
+        error = str(res.get('response') if res is not None else "no response")[:1000]
+        if res is not None and res.get('deferred'):
+            # Held back by the rate limiter, nothing was sent so it's not an attempt
+            self.db.completeNotification(nid, "pending", int(time.time() + res['retry_after']), error, attempts - 1)
+            self.count("deferred")
+            return
+        if attempts >= self.max_attempts:
+            self.db.completeNotification(nid, "dead", error=error)
+            self.count("dead")
+            logging.error(f"Outbox: notification {nid} to {recipient} dead-lettered after {attempts} attempts: {error}")
+            return
+
+        delay = res.get('retry_after') if res is not None else None
+        if delay is None:
+            delay = self.backoff(attempts)
+        self.db.completeNotification(nid, "pending", int(time.time() + delay), error)
+        self.count("retried")
+        logging.warning(f"Outbox: notification {nid} to {recipient} failed (attempt {attempts}), retry in {int(delay)}s: {error}")
+
+    def purge(self):
+        now = time.time()
+        if now < self.next_purge:
+            return
+        self.next_purge = now + 600
+        deleted = self.db.purgeNotifications(int(now - self.retention))
+        if deleted:
+            logging.info(f"Outbox: purged {deleted} old notifications")
+
+    def stats(self):
+        with self.stats_lock:
+            stats = {"workers": self.num_workers, **self.counters}
+        rows = self.db.getNotificationStats()
+        if rows is not False:
+            stats["queue"] = {status: count for status, count in rows}
+        return stats
@@ -1,115 +1,408 @@
 import threading
-import queue
 import time
+from collections import deque
 import json
 import logging
-from functools import wraps
+import hashlib
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from utils.alert_dsl import AlertDSL
+from utils.alert_dsl import AlertDSL, compile_pipeline, deliver, log_delivery
+from utils.digest import DigestBuffer
+from utils.taskqueue import KeyedTaskQueue
+from utils.maintenance import MaintenanceIndex, clear_filter_cache
+from utils.cache import Cache
+from utils.render import renderer
+from utils.templates import TemplateRegistry
 import config
 
 TZ = ZoneInfo(config.TZ)
 
-CACHE_TIMEOUT = 15
-def ttl_cache(seconds):
-    def decorator(func):
-        cache = {}
-        lock = threading.Lock()
+CACHE_TTL = getattr(config, 'CACHE_TTL', 15)
+CACHE_STALE_TTL = getattr(config, 'CACHE_STALE_TTL', 60)
+CACHE_LONG_TTL = getattr(config, 'CACHE_LONG_TTL', 600)
+CACHE_MAX_ENTRIES = getattr(config, 'CACHE_MAX_ENTRIES', 1024)
+MAINTENANCE_INDEX_REFRESH = getattr(config, 'MAINTENANCE_INDEX_REFRESH', 300)
+DIGEST_WINDOW = getattr(config, 'DIGEST_WINDOW', 60)
+DIGEST_MAX_ALERTS = getattr(config, 'DIGEST_MAX_ALERTS', 100)
+PIPELINE_PRIORITY = getattr(config, 'PIPELINE_PRIORITY', False)
+PIPELINE_PRIORITY_BOOST = getattr(config, 'PIPELINE_PRIORITY_BOOST', {"critical": 600, "warning": 120, "info": 30})
+PIPELINE_RESOLVED_BOOST = getattr(config, 'PIPELINE_RESOLVED_BOOST', 0.5)
+PIPELINE_MIN_WORKERS = getattr(config, 'PIPELINE_MIN_WORKERS', 4)
+PIPELINE_MAX_WORKERS = getattr(config, 'PIPELINE_MAX_WORKERS', 20)
+PIPELINE_SCALE_BACKLOG = getattr(config, 'PIPELINE_SCALE_BACKLOG', 10)
+PIPELINE_SCALE_TASK_AGE = getattr(config, 'PIPELINE_SCALE_TASK_AGE', 2)
+PIPELINE_IDLE_TIMEOUT = getattr(config, 'PIPELINE_IDLE_TIMEOUT', 60)
+PIPELINE_BATCH = getattr(config, 'PIPELINE_BATCH', False)
+PIPELINE_RUN_LOG_SIZE = getattr(config, 'PIPELINE_RUN_LOG_SIZE', 1000)
 
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            if len(args) > 0 and hasattr(args[0], '__class__'):
-                cache_args = args[1:]
-            else:
-                cache_args = args
-            key = str(cache_args) + str(sorted(kwargs.items()))
-            with lock:
-                if key in cache:
-                    result, timestamp = cache[key]
-                    if time.time() - timestamp < seconds:
-                        logging.debug(f"Cache hit for {func}")
-                        return result
-            result = func(*args, **kwargs)
-            with lock:
-                cache[key] = (result, time.time())
-            return result
-        wrapper.clear_cache = lambda: cache.clear()
-        return wrapper
-    return decorator
+# Head start in seconds a task gets in the priority queue: firing alerts get the
+# boost of their severity, other statuses (resolved, acked..) a fraction of it
+def task_priority(task):
+    task_id, param = task
+    if task_id == "alert":
+        return alert_priority(param)
+    if task_id == "alert_batch":
+        return max((alert_priority(alert) for alert in param), default=0)
+    return 0
+
+def alert_priority(alert):
+    boost = PIPELINE_PRIORITY_BOOST.get(alert.get("severity"), 0)
+    if alert.get("status") != "firing":
+        boost *= PIPELINE_RESOLVED_BOOST
+    return boost
+
+class WorkerState:
+    __slots__ = ("thread", "started", "tasks", "busy_time", "busy_since")
+
+    def __init__(self):
+        self.thread = None
+        self.started = time.monotonic()
+        self.tasks = 0
+        self.busy_time = 0.0
+        self.busy_since = None
 
+# Pipeline workers scale between min_workers and max_workers: the scaler adds
+# workers while the backlog per worker or the age of the oldest queued task is
+# over its threshold, workers idle for PIPELINE_IDLE_TIMEOUT exit down to
+# min_workers. max_workers also bounds the DB connections pipelines can hold.
 class AlertPipeline:
-    def __init__(self, db_handler, num_workers=10):
+    def __init__(self, db_handler, num_workers=None, outbox=None, max_workers=None):
         self.db = db_handler
-        self.num_workers = num_workers
-        self.threads = []
+        self.outbox = outbox
+        self.min_workers = num_workers if num_workers is not None else PIPELINE_MIN_WORKERS
+        self.max_workers = max(self.min_workers, max_workers if max_workers is not None else PIPELINE_MAX_WORKERS)
+        # worker slot (its queue shard) -> WorkerState
+        self.workers = {}
+        self.workers_lock = threading.Lock()
         self.thread_timeout = 20
-        self.task_queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.scaler_thread = None
+        self.scale_interval = 1.0
+        self.rate_sample = (time.monotonic(), 0)
+        self.tasks_per_sec = 0.0
+        self.counters = {
+            "scale_ups": 0,
+            "scale_downs": 0,
+            "errors": 0,
+            "runs": 0,
+            "budget_exceeded": 0,
+        }
+        # Most recent pipeline runs, newest last
+        self.run_log = deque(maxlen=PIPELINE_RUN_LOG_SIZE)
+        self.run_log_lock = threading.Lock()
+        # Tasks of the same alert fingerprint run one at a time, in order
+        self.task_queue = KeyedTaskQueue(self.max_workers, task_priority if PIPELINE_PRIORITY else None)
+        # pipeline id -> (content digest, compiled pipeline, source yaml)
+        self.compiled = {}
+        self.compiled_lock = threading.Lock()
+        self.pipelines = Cache("pipelines", maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_LONG_TTL, stale_ttl=CACHE_STALE_TTL)
+        self.templates = TemplateRegistry(db_handler, Cache("templates", maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_LONG_TTL, stale_ttl=CACHE_STALE_TTL))
+        # Matching schedules depend on the current time, keep their TTL short
+        self.schedules = Cache("schedules", maxsize=1, ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL)
+        self.maintenance_index = MaintenanceIndex()
+        self.maintenance_lock = threading.Lock()
+        self.maintenance_stale = True
+        self.digests = DigestBuffer(self.send_digest, DIGEST_WINDOW, DIGEST_MAX_ALERTS)
 
     def start(self):
-        for _ in range(self.num_workers):
-            t = threading.Thread(target=self.worker, daemon=True)
-            t.start()
-            self.threads.append(t)
+        self.digests.start()
+        self.add_workers(self.min_workers)
+        self.scaler_thread = threading.Thread(target=self.scaler, daemon=True)
+        self.scaler_thread.start()
 
     def stop(self):
-        for _ in range(self.num_workers):
-            self.task_queue.put(None)
+        self.stop_event.set()
+        if self.scaler_thread is not None:
+            self.scaler_thread.join(self.thread_timeout)
+        self.task_queue.close()
         self.task_queue.join()
-        for t in self.threads:
+        with self.workers_lock:
+            threads = [state.thread for state in self.workers.values()]
+        for t in threads:
             t.join(self.thread_timeout)
+        self.digests.stop()
+
+    def add_workers(self, count):
+        with self.workers_lock:
+            free = [slot for slot in range(self.max_workers) if slot not in self.workers]
+            for slot in free[:count]:
+                state = WorkerState()
+                state.thread = threading.Thread(target=self.worker, args=(slot, state), daemon=True)
+                self.workers[slot] = state
+                state.thread.start()
+            return len(free[:count])
+
+    def scaler(self):
+        while not self.stop_event.wait(self.scale_interval):
+            try:
+                self.autoscale()
+            except Exception as e:
+                logging.error(f"Pipeline scaler error: {e}")
+
+    def autoscale(self):
+        now = time.monotonic()
+        done = self.task_queue.counters["done"]
+        sampled_at, sampled_done = self.rate_sample
+        self.tasks_per_sec = (done - sampled_done) / max(now - sampled_at, 1e-6)
+        self.rate_sample = (now, done)
 
-    def add_task(self, task_id, param):
-        self.task_queue.put((task_id, param))
+        backlog, age = self.task_queue.ready_backlog()
+        with self.workers_lock:
+            workers = len(self.workers)
+        if workers >= self.max_workers or backlog == 0:
+            return
+        if backlog > PIPELINE_SCALE_BACKLOG * workers or age > PIPELINE_SCALE_TASK_AGE:
+            # Grow by up to half of the current pool per step
+            added = self.add_workers(max(1, workers // 2))
+            self.counters["scale_ups"] += 1
+            logging.info(f"Pipeline backlog {backlog} ready tasks, oldest {age:.1f}s: added {added} workers ({workers + added} running)")
 
-    def worker(self):
+    # Alerts are keyed by fingerprint, other tasks run in any order
+    def add_task(self, task_id, param, key=None):
+        if key is None:
+            key = param.get("alert_id") if task_id == "alert" else None
+        if key is None:
+            key = object()
+        self.task_queue.put(key, (task_id, param))
+
+    # Alerts of one webhook. With PIPELINE_BATCH the whole group is one task that
+    # holds the fingerprints of all its alerts, so it stays in order with other
+    # groups and single alerts (spool replay) carrying any of them.
+    # Without a group key alerts are queued one by one
+    def add_alerts(self, alerts, group_key=None):
+        if not alerts:
+            return
+        if PIPELINE_BATCH and group_key is not None:
+            keys = [alert["alert_id"] for alert in alerts if alert.get("alert_id") is not None]
+            self.add_task("alert_batch", alerts, key=keys or None)
+            return
+        for alert in alerts:
+            self.add_task("alert", alert)
+
+    def worker(self, slot, state):
         while True:
-            task = self.task_queue.get()
-            if task is None:
-                self.task_queue.task_done()
-                break
-            elif task[0] == "alert":
-                logging.info("Spawning alert dsl pipeline..")
-                self.alert_pipeline(task[1])
-                self.task_queue.task_done()
-            else:
-                logging.warning("Unknown task id")
-                self.task_queue.task_done()
+            item = self.task_queue.get(slot, PIPELINE_IDLE_TIMEOUT)
+            if item is None:
+                if self.task_queue.closed:
+                    break
+                with self.workers_lock:
+                    if len(self.workers) > self.min_workers:
+                        del self.workers[slot]
+                        self.counters["scale_downs"] += 1
+                        logging.info(f"Pipeline worker {slot} idle, exiting ({len(self.workers)} running)")
+                        return
+                continue
+            key, task = item
+            state.busy_since = time.monotonic()
+            try:
+                if task[0] == "alert":
+                    logging.info("Spawning alert dsl pipeline..")
+                    self.alert_pipeline(task[1])
+                elif task[0] == "alert_batch":
+                    logging.info(f"Spawning alert dsl pipeline for a batch of {len(task[1])} alerts..")
+                    self.alert_batch(task[1])
+                else:
+                    logging.warning("Unknown task id")
+            except Exception as e:
+                self.counters["errors"] += 1
+                logging.error(f"Pipeline task {task[0]} failed: {e}")
+            finally:
+                state.busy_time += time.monotonic() - state.busy_since
+                state.busy_since = None
+                state.tasks += 1
+                self.task_queue.task_done(key)
+
+    def stats(self):
+        now = time.monotonic()
+        workers = []
+        with self.workers_lock:
+            for slot, state in sorted(self.workers.items()):
+                busy_time = state.busy_time
+                if state.busy_since is not None:
+                    busy_time += now - state.busy_since
+                workers.append({
+                    "id": slot,
+                    "tasks": state.tasks,
+                    "busy": state.busy_since is not None,
+                    "busy_time": round(busy_time, 3),
+                    "utilization": round(busy_time / max(now - state.started, 1e-6), 3),
+                })
+        return {
+            "workers": len(workers),
+            "min_workers": self.min_workers,
+            "max_workers": self.max_workers,
+            "tasks_per_sec": round(self.tasks_per_sec, 2),
+            "queue": self.task_queue.stats(),
+            "worker_stats": workers,
+            **self.counters,
+        }
 
     def alert_pipeline(self, alert):
         # logging.debug(f"alert_pipeline: {alert}")
+        self.alert_batch([alert])
+
+    # Schedules, maintenances and compiled pipelines are looked up once for all
+    # alerts. Pipelines with batch: true run once with the alerts in alerts
+    # (alert is not set), the others once per alert
+    def alert_batch(self, alerts):
         schedules = self.get_matching_schedules()
         maintenance = []
+        index = None
         if len(schedules) > 0:
-            maintenance = self.get_matching_maintenance()
+            index = self.get_maintenance_index()
+            maintenance = index.active()
         for sch in schedules:
             p_id = sch.get("pipeline_id", None)
             s_name = sch.get("name", None)
             if not p_id or not s_name:
                 continue
-            p_name, p_yaml = self.get_yaml_pipeline(p_id)
+            p_name, program = self.get_compiled_pipeline(p_id)
             logging.info(f"Pipeline name: {p_name}, Schedule: {s_name}")
-            # logging.debug("YAML: %s", p_yaml)
-            dsl = AlertDSL(self.db, alert, sch, maintenance)
-            if dsl is None:
+            if program is None:
                 logging.error("Pipeline YAML parser error")
                 continue
-            ctx = dsl.run_dsl(p_yaml)
+            if program.batch:
+                dsl = AlertDSL(self.db, None, sch, maintenance, index, self.templates, self.outbox, self.digests, alerts)
+                self.run_program(dsl, program, p_id, p_name, s_name, alerts)
+                continue
+            for alert in alerts:
+                dsl = AlertDSL(self.db, alert, sch, maintenance, index, self.templates, self.outbox, self.digests, alerts)
+                self.run_program(dsl, program, p_id, p_name, s_name, [alert])
+
+    def run_program(self, dsl, program, p_id, p_name, s_name, alerts):
+        started = time.time()
+        status = "ok"
+        error = None
+        try:
+            ctx = dsl.run_dsl(program)
             # logging.debug(ctx)
+            if dsl.events:
+                status = "budget_exceeded"
+        except Exception as e:
+            status = "error"
+            error = str(e)
+            logging.error(f"Pipeline {p_name} failed: {e}")
+        entry = {
+            "started_at": started,
+            "duration": round(time.time() - started, 4),
+            "pipeline_id": p_id,
+            "pipeline": p_name,
+            "schedule": s_name,
+            "alert_ids": [alert.get("alert_id") for alert in alerts],
+            "steps": dsl.steps,
+            "status": status,
+            "events": dsl.events,
+        }
+        if error is not None:
+            entry["error"] = error
+        with self.run_log_lock:
+            self.run_log.append(entry)
+            self.counters["runs"] += 1
+            if status == "budget_exceeded":
+                self.counters["budget_exceeded"] += 1
+
+    # Newest first, optionally only runs with the given status
+    def get_run_log(self, status=None, limit=100):
+        with self.run_log_lock:
+            runs = list(self.run_log)
+        runs.reverse()
+        if status is not None:
+            runs = [run for run in runs if run["status"] == status]
+        return runs[:max(0, limit)]
+
+    def send_digest(self, channel, recipient, destination, payload, key):
+        res = deliver(channel, recipient, destination, payload, key, None, self.outbox)
+        log_delivery("digest: ", channel, recipient, res)
+        return res
+
+    # Pipelines are parsed once per content version, alerts only execute the compiled program
+    def get_compiled_pipeline(self, pid):
+        p_name, p_yaml = self.get_yaml_pipeline(pid)
+        with self.compiled_lock:
+            cached = self.compiled.get(pid)
+        if cached is not None and cached[2] is p_yaml:
+            return p_name, cached[1]
+        source_hash = hashlib.sha256(p_yaml.encode('utf-8')).hexdigest()
+        if cached is not None and cached[0] == source_hash:
+            program = cached[1]
+        else:
+            program = compile_pipeline(p_yaml)
+        with self.compiled_lock:
+            self.compiled[pid] = (source_hash, program, p_yaml)
+        return p_name, program
+
+    def invalidate_pipeline(self, pid):
+        with self.compiled_lock:
+            self.compiled.pop(int(pid), None)
+        self.pipelines.invalidate(int(pid))
+
+    # Configuration change made by another AlertHub instance, see utils/changes.py
+    def apply_change(self, entity, key=None):
+        if entity == "pipeline":
+            if key is None:
+                self.pipelines.clear()
+            else:
+                self.invalidate_pipeline(key)
+        # Team changes rewrite the people of schedules
+        elif entity in ("schedule", "schedule_group", "user", "team"):
+            self.invalidate_schedules()
+        elif entity == "maintenance":
+            self.invalidate_maintenance(key)
+        elif entity == "template":
+            self.invalidate_template(key)
+        elif entity == "all":
+            with self.compiled_lock:
+                self.compiled.clear()
+            self.pipelines.clear()
+            self.templates.invalidate()
+            self.invalidate_schedules()
+            self.invalidate_maintenance()
+
+    # A new template only needs the cached unknown ids dropped, hence tid=None clears all
+    def invalidate_template(self, tid=None):
+        self.templates.invalidate(tid)
+        if tid is not None:
+            renderer.invalidate(int(tid))
+
+    # Schedules, schedule groups and their people are cached together
+    def invalidate_schedules(self):
+        self.schedules.clear()
+
+    # Apply a maintenance change to the index, a full reload without mid
+    def invalidate_maintenance(self, mid=None):
+        if mid is None:
+            clear_filter_cache()
+            self.maintenance_stale = True
+            return
+        row = self.db.getMaintenance(mid)
+        if row is False:
+            self.maintenance_stale = True
+        elif row is None:
+            self.maintenance_index.remove(int(mid))
+        else:
+            self.maintenance_index.update(row)
 
-    @ttl_cache(CACHE_TIMEOUT)
     def get_yaml_pipeline(self, pid):
+        return self.pipelines.get(int(pid), lambda: self.load_yaml_pipeline(pid), ("", "---"))
+
+    def load_yaml_pipeline(self, pid):
         row = self.db.getPipeline(pid)
+        if row is False:
+            raise LookupError(f"pipeline {pid} could not be loaded")
         if not row:
             return "", "---"
         name = row[1] or ""
         yaml = row[3] or "---"
         return name, yaml
 
-    @ttl_cache(CACHE_TIMEOUT)
     def get_matching_schedules(self):
+        return self.schedules.get("matching", self.load_matching_schedules, [])
+
+    def load_matching_schedules(self):
         rows = self.db.getMatchingSchedules()
         scheds = []
+        if rows is False:
+            raise LookupError("matching schedules could not be loaded")
         if rows is None:
             return []
         for s in rows:
@@ -126,20 +419,17 @@ class AlertPipeline:
             })
         return scheds
 
-    @ttl_cache(CACHE_TIMEOUT)
-    def get_matching_maintenance(self):
-        rows = self.db.getMatchingMaintenance()
-        if rows is None:
-            return []
-        maint = [
-            {
-                "name": r[1],
-                "description": r[2],
-                "filter": r[3],
-                "oncall_groups": r[4],
-                "starts_at": datetime.fromtimestamp(r[5], tz=TZ).isoformat(),
-                "ends_at": datetime.fromtimestamp(r[6], tz=TZ).isoformat()
-            }
-            for r in rows
-        ]
-        return maint
\ No newline at end of file
+    def get_maintenance_index(self):
+        index = self.maintenance_index
+        if not self.maintenance_stale and time.time() - index.loaded_at < MAINTENANCE_INDEX_REFRESH:
+            return index
+        with self.maintenance_lock:
+            if self.maintenance_stale or time.time() - index.loaded_at >= MAINTENANCE_INDEX_REFRESH:
+                rows = self.db.getActiveMaintenances()
+                if rows is False:
+                    logging.error("Error loading maintenances, keeping the previous index")
+                else:
+                    self.maintenance_stale = False
+                    index.load(rows)
+                    logging.debug(f"Maintenance index loaded: {len(rows)} windows")
+        return index
\ No newline at end of file
@@ -53,8 +53,16 @@ class PipelineValidator:
             self.CallStep,
         ), extra=PREVENT_EXTRA)
 
+        self.DigestOptions = Any(bool, {
+            Optional("window"): int,
+            Optional("templates"): { str: object },
+            Optional("flush_on"): [str],
+        })
+
         self.SCRIPT_SCHEMA = Schema({
             Optional("templates", default={}): { str: object },
+            Optional("digest"): self.DigestOptions,
+            Optional("batch"): bool,
             Optional("vars", default={}): { str: object },
             Optional("steps", default=[]): [self.Step],
         }, extra=PREVENT_EXTRA)
@@ -1,28 +1,115 @@
 import importlib
 import psycopg2.pool
+import psycopg2.extras
+import psycopg2.extensions
 from datetime import datetime, timedelta
 import os
 import json
+import uuid
 import logging
 
+# Pooled connection that remembers which server-side prepared statements it holds
+class PreparedConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+# Errors that mean the database is unreachable rather than that it rejected the data
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
 class AlertsDatabase:
+    # Configuration changes are announced on this channel, see utils/changes.py
+    CHANGES_CHANNEL = "alerthub_changes"
+
+    MATCHING_SCHEDULES_SQL = '''
+            SELECT
+                s.id,
+                s.name,
+                sg.name AS group,
+                sg.id AS group_id,
+                s.starts_at,
+                s.ends_at,
+                s.mute_starts,
+                s.mute_ends,
+                jsonb_agg(
+                    DISTINCT jsonb_build_object(
+                        'name', u.name,
+                        'email', u.email,
+                        'telegram_id', u.telegram_id,
+                        'ntfy', u.ntfy,
+                        'apprise', u.apprise,
+                        'notifiers', u.notifiers
+                    )
+                ) FILTER (WHERE u.id IS NOT NULL) AS people,
+                sg.pipeline_id
+            FROM Schedules s
+            LEFT JOIN ScheduleGroups sg ON s.group_id = sg.id
+            LEFT JOIN LATERAL jsonb_array_elements_text(s.people) AS p(uid) ON TRUE
+            LEFT JOIN Users u ON u.id = p.uid::bigint
+            WHERE s.starts_at <= $1 AND s.ends_at >= $2
+            GROUP BY s.id, s.name, sg.name, sg.id, sg.pipeline_id, s.starts_at, s.ends_at, s.mute_starts, s.mute_ends
+        '''
+
     def __init__(self, path):
         try:
-            self.cpool = psycopg2.pool.SimpleConnectionPool(1, 50, path)
+            self.cpool = psycopg2.pool.SimpleConnectionPool(1, 50, path, connection_factory=PreparedConnection)
         except:
             raise Exception("Unable to create Postgres connection pool")
+        self.dsn = path
+        # Tells our own change notifications apart from other AlertHub instances
+        self.instance_id = uuid.uuid4().hex
+        # Statement registry: name -> SQL with $n placeholders, prepared lazily on every pooled connection
+        self.statements = {}
+        self.registerStatement("matching_schedules", self.MATCHING_SCHEDULES_SQL)
+        self.registerStatement("matching_maintenance", "SELECT * FROM Maintenance WHERE starts_at <= $1 AND ends_at >= $2")
+
+    def registerStatement(self, name, sql):
+        # psycopg2 style %s placeholders are turned into positional $n ones
+        if '%s' in sql:
+            parts = sql.split('%s')
+            sql = parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+        self.statements[name] = sql
+
+    def prepareStatement(self, cursor, name):
+        db = cursor.connection
+        if name not in db.prepared:
+            cursor.execute(f"PREPARE {name} AS {self.statements[name]}")
+            db.prepared.add(name)
+
+    def executePrepared(self, cursor, name, params=()):
+        self.prepareStatement(cursor, name)
+        if len(params) > 0:
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cursor.execute(f"EXECUTE {name}")
+
+    # Queued in the caller's transaction, listeners only see it after commit
+    def notifyChange(self, cursor, entity, key=None):
+        payload = json.dumps({"entity": entity, "id": key, "origin": self.instance_id})
+        cursor.execute("SELECT pg_notify(%s, %s)", (self.CHANGES_CHANNEL, payload))
 
     def get_applied_versions(self, cursor):
         cursor.execute("SELECT version FROM migrations")
         return {row[0] for row in cursor.fetchall()}
 
-    def apply_migration(self, cursor, version, name):
+    def apply_migration(self, db, cursor, version, name):
         logging.info(f"Apply DB migration: {version}_{name}")
         try:
             module = importlib.import_module(f"migrations.{version}_{name}")
-            if hasattr(module, 'up'):
-                module.up(cursor)
-            cursor.execute("INSERT INTO migrations (version) VALUES (%s)", (version,))
+            if getattr(module, 'TRANSACTIONAL', True):
+                if hasattr(module, 'up'):
+                    module.up(cursor)
+                cursor.execute("INSERT INTO migrations (version) VALUES (%s)", (version,))
+            else:
+                # Non-transactional migrations (e.g. CREATE INDEX CONCURRENTLY) run in autocommit mode
+                db.commit()
+                db.autocommit = True
+                try:
+                    if hasattr(module, 'up'):
+                        module.up(cursor)
+                    cursor.execute("INSERT INTO migrations (version) VALUES (%s)", (version,))
+                finally:
+                    db.autocommit = False
         except Exception as e:
             logging.error(f"Failed to run migration for {version}: {e}")
 
@@ -51,7 +138,7 @@ class AlertsDatabase:
                 name = _vn[1]
                 if version not in applied:
                     name = name.replace("/", ".").replace(".py", "")
-                    self.apply_migration(cursor, version, name)
+                    self.apply_migration(db, cursor, version, name)
             db.commit()
             cursor.close()
         except (Exception, psycopg2.DatabaseError) as e:
@@ -60,26 +147,25 @@ class AlertsDatabase:
             if db:
                 self.cpool.putconn(db)
 
-    # Alerts
-    def getAlertState(self, alert_id):
+    # Cheap health check, broken pooled connections get discarded on the way
+    def ping(self):
         db = None
         try:
             db = self.cpool.getconn()
             cursor = db.cursor()
-            cursor.execute("SELECT alert_id, status, alert_count FROM Alerts WHERE alert_id=%s", (alert_id,))
-            row = cursor.fetchone()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
             cursor.close()
-            if row is not None:
-                return row[0], row[1], row[2]
-            else:
-                return None, None, None
+            db.rollback()
+            return True
         except (Exception, psycopg2.DatabaseError) as e:
-            logging.error(f"Database error: {e}")
-            return None, None
+            logging.warning(f"Database health check failed: {e}")
+            return False
         finally:
             if db:
                 self.cpool.putconn(db)
 
+    # Alerts
     def setAlertStatus(self, alert_fingerprint, status, comment, update_history = True, history_status = None):
         db = None
         timestamp = int(datetime.now().timestamp())
@@ -118,100 +204,127 @@ class AlertsDatabase:
             if db:
                 self.cpool.putconn(db)
 
-    def upsert(self, alert):
+    # Map an Alertmanager alert to the alert_upsert() arguments
+    def alertParams(self, alert):
+        labels = alert['labels']
+        startsAt = datetime.fromisoformat(alert['startsAt']).timestamp()
+        endsAt = datetime.fromisoformat(alert['endsAt']).timestamp()
+        if endsAt < 0:
+            endsAt = 0
+        return (alert['fingerprint'],
+                labels.get('alertname', "-"),
+                labels.get('severity', "-"),
+                labels.get('instance', "-"),
+                labels.get('job', "-"),
+                alert['status'],
+                json.dumps(alert['annotations']),
+                json.dumps(labels),
+                alert.get('generatorURL', "-"),
+                int(datetime.now().timestamp()),
+                endsAt,
+                startsAt)
+
+    # Build the alert dict handed over to the pipeline from alert_upsert() output
+    def alertResult(self, alert, params, row):
+        status, startsAt, alert_count = row
+        return {"alert_id": params[0],
+                "alertname": params[1],
+                "severity": params[2],
+                "instance": params[3],
+                "job": params[4],
+                "status": status,
+                "annotations": alert['annotations'],
+                "labels": alert['labels'],
+                "generatorURL": params[8],
+                "updatedAt": params[9],
+                "endsAt": params[10],
+                "startsAt": startsAt,
+                "alert_count": alert_count}
+
+    # Apply all alerts of one Alertmanager webhook in a single transaction.
+    # Returns per-alert results in payload order (None for malformed alerts and
+    # rows the database rejected), or None if the database could not be reached.
+    # alert_upsert() holds an advisory lock per alert_id until commit, so rows
+    # are applied in alert_id order: concurrent webhooks with the same alerts
+    # then lock them in the same order and can't deadlock. If the batch is
+    # rejected (a bad row), alerts are stored one by one so only the bad ones
+    # are lost.
+    def upsertBatch(self, alerts):
+        rows = []
+        params = []
+        for idx, alert in enumerate(alerts):
+            try:
+                p = self.alertParams(alert)
+            except (KeyError, TypeError, ValueError) as e:
+                logging.error(f"Malformed alert skipped: {e}")
+                params.append(None)
+                continue
+            params.append(p)
+            rows.append((idx,) + p)
+        rows.sort(key=lambda row: row[1])
+
+        results = [None] * len(alerts)
+        if len(rows) == 0:
+            return results
+
         db = None
         try:
             db = self.cpool.getconn()
-            cursor = db.cursor()
-
-            fingerprint = alert['fingerprint']
-            alertid, status, alert_count = self.getAlertState(fingerprint)
-
-            logging.debug(f"Alert {fingerprint} {alertid} {alert_count} {status} to {alert['status']}")
-
-            job = alert['labels'].get('job', "-")
-            instance  = alert['labels'].get('instance', "-")
-            severity =  alert['labels'].get('severity', "-")
-            alertname = alert['labels'].get('alertname', "-")
-            generatorURL = alert.get('generatorURL', "-")
-
-            startsAt = datetime.fromisoformat(alert['startsAt']).timestamp()
-            endsAt = datetime.fromisoformat(alert['endsAt']).timestamp()
-            updatedAt = int(datetime.now().timestamp())
-
-            if endsAt < 0:
-                endsAt = 0
-
-            if alertid == fingerprint:
-                history_inserts = {
-                    ('acked', 'resolved'): (endsAt, 'resolved'),
-                    ('resolved', 'firing'): (startsAt, 'firing'),
-                    ('firing', 'resolved'): (endsAt, 'resolved'),
-                }
-                if alert['status'] != status:
-                    if status in ('muted', 'acked') and alert['status'] == 'firing':
-                        alert_count += 1
-                    elif status in ('muted', 'acked') and alert['status'] == 'resolved':
-                        alert_count = 1
-                    elif status in ('resolved', 'firing') and alert['status'] in ('firing', 'resolved'):
-                        alert_count = 1
-
-                    if (status, alert['status']) in history_inserts:
-                        ts, new_status = history_inserts[(status, alert['status'])]
-                        status = new_status
-                        cursor.execute(
-                            "INSERT INTO AlertsHistory (timestamp, event_timestamp, alert_id, status, comment) "
-                            "VALUES (%s, %s, %s, %s, %s)",
-                            (updatedAt, ts, fingerprint, status, '')
-                        )
-                    cursor.execute(
-                        "UPDATE Alerts SET status=%s, updatedAt=%s, endsAt=%s, startsAt=%s, alert_count=%s "
-                        "WHERE alert_id=%s",
-                        (status, updatedAt, endsAt, startsAt, alert_count, fingerprint)
-                    )
-                else:
-                    if status == 'firing':
-                        alert_count += 1
-                        cursor.execute(
-                            "UPDATE Alerts SET status=%s, updatedAt=%s, endsAt=%s, startsAt=%s, alert_count=%s "
-                            "WHERE alert_id=%s",
-                            (status, updatedAt, endsAt, startsAt, alert_count, fingerprint)
-                        )
-                db.commit()
-                cursor.close()
-            else:
-                alert_count = 1
-                status = alert['status']
-                cursor.execute("""
-                    INSERT INTO Alerts (alert_id, alertname, severity, instance, job, status, annotations, labels, generatorURL, updatedAt, endsAt, startsAt, alert_count)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (fingerprint, alertname, severity, instance, job, status, json.dumps(alert['annotations']), json.dumps(alert['labels']), generatorURL, updatedAt, endsAt, startsAt, alert_count))
-                if status == 'resolved':
-                    startsAt = endsAt
-                cursor.execute("INSERT INTO AlertsHistory (timestamp, event_timestamp, alert_id, status, comment) VALUES (%s, %s, %s, %s, %s)", (updatedAt, startsAt, fingerprint, status, ''))
+            try:
+                cursor = db.cursor()
+                res = psycopg2.extras.execute_values(cursor, """
+                    SELECT v.idx, r.*
+                    FROM (VALUES %s) AS v(idx, alert_id, alertname, severity, instance, job, status, annotations, labels, generatorURL, updatedAt, endsAt, startsAt)
+                    CROSS JOIN LATERAL alert_upsert(v.alert_id, v.alertname, v.severity, v.instance, v.job, v.status, v.annotations, v.labels, v.generatorURL, v.updatedAt, v.endsAt, v.startsAt) r
+                    """,
+                    rows,
+                    template="(%s, %s, %s, %s, %s, %s, %s, %s::jsonb, %s::jsonb, %s, %s::bigint, %s::bigint, %s::bigint)",
+                    page_size=len(rows),
+                    fetch=True
+                )
                 db.commit()
                 cursor.close()
-            return {"alert_id": fingerprint,
-                    "alertname": alertname,
-                    "severity": severity,
-                    "instance": instance,
-                    "job": job,
-                    "status": status,
-                    "annotations": alert['annotations'],
-                    "labels": alert['labels'],
-                    "generatorURL": generatorURL,
-                    "updatedAt": updatedAt,
-                    "endsAt": endsAt,
-                    "startsAt": startsAt,
-                    "alert_count": alert_count}
+            except CONNECTION_ERRORS:
+                raise
+            except (Exception, psycopg2.DatabaseError) as e:
+                logging.warning(f"Alert batch rejected, storing alerts one by one: {e}")
+                db.rollback()
+                res = self.upsertRows(db, rows)
+            for row in res:
+                idx = row[0]
+                results[idx] = self.alertResult(alerts[idx], params[idx], row[1:])
+            logging.debug(f"Alert batch of {len(rows)} applied")
+            return results
         except (Exception, psycopg2.DatabaseError) as e:
             logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
             return None
         finally:
             if db:
                 self.cpool.putconn(db)
 
-    def queryAlertsRange(self, range_start=None, range_end=None, fts=None, status=None, offset=0, limit=10000, history=False):
+    # One transaction per row, rows the database rejects are logged and left out
+    def upsertRows(self, db, rows):
+        res = []
+        cursor = db.cursor()
+        for row in rows:
+            try:
+                cursor.execute(
+                    "SELECT %s, r.* FROM alert_upsert(%s, %s, %s, %s, %s, %s, %s::jsonb, %s::jsonb, %s, %s::bigint, %s::bigint, %s::bigint) r",
+                    row
+                )
+                res.append(cursor.fetchone())
+                db.commit()
+            except CONNECTION_ERRORS:
+                raise
+            except (Exception, psycopg2.DatabaseError) as e:
+                db.rollback()
+                logging.error(f"Alert {row[1]} rejected by the database: {e}")
+        cursor.close()
+        return res
+
+    def alertsRangeQuery(self, range_start=None, range_end=None, fts=None, status=None, history=False, after=None, total=True):
         if range_start is None or range_end is None:
             now = datetime.now()
             rangeStart = now.timestamp()
@@ -220,11 +333,11 @@ class AlertsDatabase:
             rangeStart = datetime.fromisoformat(range_start).timestamp()
             rangeEnd = datetime.fromisoformat(range_end).timestamp()
 
+        total_count = "COUNT(*) OVER() AS total_count" if total else "NULL AS total_count"
         sql = list()
-        sql_query = ""
+        params = [rangeEnd, rangeStart]
         if history:
-            # Consider to use "EXPLAIN (FORMAT JSON) SELECT 1 FROM /* your query */" rather than "SELECT count(*) FROM /* your query */" here?
-            sql_query = """
+            sql.append("""
                 SELECT
                    ah.id,
                    a.alert_id,
@@ -240,14 +353,15 @@ class AlertsDatabase:
                    a.endsAt,
                    ah.event_timestamp AS startsAt,
                    a.alert_count,
-                   COUNT(*) OVER() AS total_count
+                   %s
                 FROM Alertshistory ah
                 JOIN Alerts a
                     ON a.alert_id = ah.alert_id
-                WHERE ah.event_timestamp >= %s AND ah.event_timestamp <= %s
-            """ % (rangeEnd, rangeStart)
+                WHERE ah.event_timestamp >= %%s AND ah.event_timestamp <= %%s
+            """ % total_count)
+            status_column, sort_column, id_column = "ah.status", "ah.event_timestamp", "ah.id"
         else:
-            sql_query = """
+            sql.append("""
                 SELECT id,
                     alert_id,
                     alertname,
@@ -262,37 +376,84 @@ class AlertsDatabase:
                     endsAt,
                     startsAt,
                     alert_count,
-                    COUNT(*) OVER() AS total_count FROM Alerts
-                WHERE startsAt >= %s AND startsAt <= %s
-                """ % (rangeEnd, rangeStart)
+                    %s FROM Alerts
+                WHERE startsAt >= %%s AND startsAt <= %%s
+                """ % total_count)
+            status_column, sort_column, id_column = "status", "startsAt", "id"
 
-        sql.append(sql_query)
         if fts is not None:
-            sql.append("AND search_fts @@ to_tsquery('simple', '%s')" % fts)
+            sql.append("AND search_fts @@ to_tsquery('simple', %s)")
+            params.append(fts)
         if status is not None:
-            sql.append("AND status = %s" % status)
-
-        if history:
-            sql.append("ORDER BY ah.event_timestamp DESC LIMIT %s OFFSET %s" % (limit, offset))
+            sql.append(f"AND {status_column} = %s")
+            params.append(status)
+        # keyset pagination: continue right after the last (timestamp, id) of the previous page
+        if after is not None:
+            sql.append(f"AND ({sort_column}, {id_column}) < (%s, %s)")
+            params.extend(after)
+
+        return " ".join(sql), params, f"ORDER BY {sort_column} DESC, {id_column} DESC"
+
+    # Every combination of optional filters gets its own prepared statement
+    def alertsRangeStatement(self, fts, status, history, after, total, mode):
+        name = "alerts_range_%s_%d%d%d%d%d" % (mode, history, fts is not None, status is not None, after is not None, total)
+        if name not in self.statements:
+            query, _, order = self.alertsRangeQuery(fts=fts, status=status, history=history, after=after, total=total)
+            if mode == "page":
+                query = f"{query} {order} LIMIT %s OFFSET %s"
+            elif mode == "cursor":
+                query = f"{query} {order} LIMIT %s"
+            self.registerStatement(name, query)
+        return name
+
+    def queryAlertsRange(self, range_start=None, range_end=None, fts=None, status=None, offset=0, limit=10000, history=False, after=None, total=True):
+        _, params, _ = self.alertsRangeQuery(range_start, range_end, fts, status, history, after, total)
+        if after is not None:
+            name = self.alertsRangeStatement(fts, status, history, after, total, "cursor")
+            params = params + [limit]
         else:
-            sql.append("ORDER BY startsAt DESC LIMIT %s OFFSET %s" % (limit, offset))
-        sql.append(";")
-        query = " ".join(sql)
+            name = self.alertsRangeStatement(fts, status, history, after, total, "page")
+            params = params + [limit, offset]
 
-        #logging.debug(query)
         db = None
         try:
             db = self.cpool.getconn()
             cursor = db.cursor()
-            cursor.execute(query)
+            self.executePrepared(cursor, name, params)
             rows = cursor.fetchall()
             cursor.close()
+            db.rollback()
             if rows is not None:
                 return rows
             else:
                 return None
         except (Exception, psycopg2.DatabaseError) as e:
             logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return None
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    # Planner estimate of the number of rows in range, avoids counting millions of rows per page
+    def estimateAlertsRange(self, range_start=None, range_end=None, fts=None, status=None, history=False):
+        _, params, _ = self.alertsRangeQuery(range_start, range_end, fts, status, history, total=False)
+        name = self.alertsRangeStatement(fts, status, history, None, False, "count")
+        db = None
+        try:
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            self.prepareStatement(cursor, name)
+            cursor.execute(f"EXPLAIN (FORMAT JSON) EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            plan = cursor.fetchone()[0]
+            cursor.close()
+            db.rollback()
+            return int(plan[0]['Plan']['Plan Rows'])
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
             return None
         finally:
             if db:
@@ -382,6 +543,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO Users (name, password, role, email, notifiers, telegram_id, ntfy, apprise, timezone) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", (user_name, user_password, user_role, user_email, notifiers, telegram_id, ntfy, apprise, timezone))
+            self.notifyChange(cursor, "user", user_name)
             db.commit()
             cursor.close()
             return True
@@ -402,6 +564,7 @@ class AlertsDatabase:
                 cursor.execute("UPDATE Users SET password=%s, role=%s, email=%s, notifiers=%s, telegram_id=%s, ntfy=%s, apprise=%s, timezone=%s WHERE name=%s", (password, role, email, notifiers, telegram_id, ntfy, apprise, timezone, name))
             else:
                 cursor.execute("UPDATE Users SET role=%s, email=%s, notifiers=%s, telegram_id=%s, ntfy=%s, apprise=%s, timezone=%s WHERE name=%s", (role, email, notifiers, telegram_id, ntfy, apprise, timezone, name))
+            self.notifyChange(cursor, "user", name)
             db.commit()
             cursor.close()
             return True
@@ -418,6 +581,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("DELETE FROM Users WHERE name=%s", (uid,))
+            self.notifyChange(cursor, "user", uid)
             db.commit()
             cursor.close()
             return True
@@ -435,6 +599,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO SearchFilters (shared, user_id, name, query) VALUES (%s, %s, %s, %s)", (shared, user_id, query_name, query))
+            self.notifyChange(cursor, "search")
             db.commit()
             cursor.close()
             return True
@@ -451,6 +616,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("UPDATE SearchFilters SET shared=%s, user_id=%s, name=%s, query=%s WHERE id=%s", (shared, user_id, query_name, query, sid))
+            self.notifyChange(cursor, "search", sid)
             db.commit()
             cursor.close()
             return True
@@ -486,6 +652,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("DELETE FROM SearchFilters WHERE id=%s", (sid))
+            self.notifyChange(cursor, "search", sid)
             db.commit()
             cursor.close()
             return True
@@ -523,6 +690,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO Teams (name, members) VALUES (%s,%s)", (team_name, team_members))
+            self.notifyChange(cursor, "team")
             db.commit()
             cursor.close()
             return True
@@ -540,6 +708,7 @@ class AlertsDatabase:
             cursor = db.cursor()
             cursor.execute("DELETE FROM Teams WHERE id=%s", (tId,))
             cursor.execute("UPDATE ScheduleGroups SET team_id=0 WHERE team_id=%s", (tId,))
+            self.notifyChange(cursor, "team", tId)
             db.commit()
             cursor.close()
             return True
@@ -578,6 +747,7 @@ class AlertsDatabase:
                 AND Teams.id = %s
             )
             ''', (team_id,team_id))
+            self.notifyChange(cursor, "team", team_id)
             db.commit()
             cursor.close()
             return True
@@ -614,6 +784,7 @@ class AlertsDatabase:
                     ),'[]'::jsonb
                 )
                 ''', (mId,))
+            self.notifyChange(cursor, "user", mId)
             db.commit()
             cursor.close()
             return True
@@ -650,6 +821,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO Schedules (name, group_id, starts_at, ends_at, mute_starts, mute_ends, people) VALUES (%s,%s,%s,%s,%s,%s,%s)", (name, group_id, starts_at, ends_at, mute_start, mute_end, people))
+            self.notifyChange(cursor, "schedule")
             db.commit()
             cursor.close()
             return True
@@ -666,6 +838,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("DELETE FROM Schedules WHERE id=%s", (sid,))
+            self.notifyChange(cursor, "schedule", sid)
             db.commit()
             cursor.close()
             return True
@@ -682,6 +855,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("UPDATE Schedules SET name=%s, group_id=%s, starts_at=%s, ends_at=%s, mute_starts=%s, mute_ends=%s, people=%s WHERE id=%s", (name, group_id, starts_at, ends_at, mute_start, mute_end, people, sid))
+            self.notifyChange(cursor, "schedule", sid)
             db.commit()
             cursor.close()
             return True
@@ -718,6 +892,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO ScheduleGroups (name, pipeline_id, team_id) VALUES (%s, %s, %s)", (name, pipeline_id, team_id))
+            self.notifyChange(cursor, "schedule_group")
             db.commit()
             cursor.close()
             return True
@@ -745,6 +920,8 @@ class AlertsDatabase:
                 ''', (int(gid),))
             cursor.execute("DELETE FROM ScheduleGroups WHERE id=%s", (gid,))
             cursor.execute("UPDATE Schedules SET group_id=0 WHERE group_id=%s", (gid,))
+            self.notifyChange(cursor, "schedule_group", gid)
+            self.notifyChange(cursor, "maintenance")
             db.commit()
             cursor.close()
             return True
@@ -761,6 +938,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("UPDATE ScheduleGroups SET name=%s, pipeline_id=%s, team_id=%s WHERE id=%s", (name, pipeline_id, team_id, sid))
+            self.notifyChange(cursor, "schedule_group", sid)
             db.commit()
             cursor.close()
             return True
@@ -816,6 +994,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO Pipelines (name, description, yaml_content) VALUES (%s, %s, %s)", (name, description, yaml_content))
+            self.notifyChange(cursor, "pipeline")
             db.commit()
             cursor.close()
             return True
@@ -833,6 +1012,7 @@ class AlertsDatabase:
             cursor = db.cursor()
             cursor.execute("DELETE FROM Pipelines WHERE id=%s", (pid,))
             cursor.execute("UPDATE ScheduleGroups SET pipeline_id=0 WHERE pipeline_id=%s", (pid,))
+            self.notifyChange(cursor, "pipeline", pid)
             db.commit()
             cursor.close()
             return True
@@ -849,6 +1029,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("UPDATE Pipelines SET name=%s, description=%s, yaml_content=%s WHERE id=%s", (name, description, yaml_content, pid))
+            self.notifyChange(cursor, "pipeline", pid)
             db.commit()
             cursor.close()
             return True
@@ -879,6 +1060,26 @@ class AlertsDatabase:
             if db:
                 self.cpool.putconn(db)
 
+    # (id, template) rows for all given ids in one round trip
+    def getTemplatesByIds(self, tids):
+        db = None
+        try:
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute("SELECT id, template FROM Templates WHERE id = ANY(%s)", (list(tids),))
+            rows = cursor.fetchall()
+            cursor.close()
+            db.rollback()
+            return rows
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
     def getTemplate(self, tid):
         db = None
         try:
@@ -904,6 +1105,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO Templates (name, description, template) VALUES (%s, %s, %s)", (name, description, template))
+            self.notifyChange(cursor, "template")
             db.commit()
             cursor.close()
             return True
@@ -920,6 +1122,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("DELETE FROM Templates WHERE id=%s", (tid,))
+            self.notifyChange(cursor, "template", tid)
             db.commit()
             cursor.close()
             return True
@@ -936,6 +1139,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("UPDATE Templates SET name=%s, description=%s, template=%s WHERE id=%s", (name, description, template, tid))
+            self.notifyChange(cursor, "template", tid)
             db.commit()
             cursor.close()
             return True
@@ -991,6 +1195,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("INSERT INTO Maintenance (name, description, filter, oncall_groups, starts_at, ends_at) VALUES (%s,%s,%s,%s,%s,%s)", (name, description, filter, oncall_groups, starts_at, ends_at))
+            self.notifyChange(cursor, "maintenance")
             db.commit()
             cursor.close()
             return True
@@ -1007,6 +1212,7 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("DELETE FROM Maintenance WHERE id=%s", (mid,))
+            self.notifyChange(cursor, "maintenance", mid)
             db.commit()
             cursor.close()
             return True
@@ -1023,11 +1229,212 @@ class AlertsDatabase:
             db = self.cpool.getconn()
             cursor = db.cursor()
             cursor.execute("UPDATE Maintenance SET name=%s, description=%s, filter=%s, oncall_groups=%s, starts_at=%s, ends_at=%s WHERE id=%s", (name, description, filter, oncall_groups, starts_at, ends_at, mid))
+            self.notifyChange(cursor, "maintenance", mid)
+            db.commit()
+            cursor.close()
+            return True
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+# Notification outbox
+    # Returns the new row id, None if the key was already queued, False on error
+    def enqueueNotification(self, key, alert_id, channel, recipient, destination, payload):
+        db = None
+        try:
+            now = int(datetime.now().timestamp())
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute('''
+                INSERT INTO NotificationOutbox (idempotency_key, alert_id, channel, recipient, destination, payload, next_attempt_at, created_at, updated_at)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                    ON CONFLICT (idempotency_key) DO NOTHING
+                    RETURNING id
+                ''', (key, alert_id, channel, recipient, destination, json.dumps(payload), now, now, now))
+            row = cursor.fetchone()
+            db.commit()
+            cursor.close()
+            return row[0] if row is not None else None
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    # Lease due deliveries to this worker. Rows of a crashed worker come back once their lease expires
+    def claimNotifications(self, limit, lease):
+        db = None
+        try:
+            now = int(datetime.now().timestamp())
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute('''
+                UPDATE NotificationOutbox o
+                    SET status = 'sending', attempts = o.attempts + 1, next_attempt_at = %s, updated_at = %s
+                    WHERE o.id IN (
+                        SELECT id FROM NotificationOutbox
+                            WHERE status IN ('pending', 'sending') AND next_attempt_at <= %s
+                            ORDER BY next_attempt_at
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING o.id, o.alert_id, o.channel, o.recipient, o.destination, o.payload, o.attempts
+                ''', (now + lease, now, now, limit))
+            rows = cursor.fetchall()
+            db.commit()
+            cursor.close()
+            return rows
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    # Extend the lease of claimed notifications, given as (id, attempts). Returns
+    # the ids still held: a row whose lease ran out and was claimed again by
+    # another worker has moved on to a higher attempts count
+    def renewNotifications(self, jobs, lease):
+        db = None
+        try:
+            now = int(datetime.now().timestamp())
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute('''
+                UPDATE NotificationOutbox o SET next_attempt_at=%s, updated_at=%s
+                    FROM unnest(%s::bigint[], %s::int[]) AS v(id, attempts)
+                    WHERE o.id = v.id AND o.attempts = v.attempts AND o.status = 'sending'
+                    RETURNING o.id
+                ''', (now + lease, now, [nid for nid, _ in jobs], [attempts for _, attempts in jobs]))
+            renewed = {row[0] for row in cursor.fetchall()}
+            db.commit()
+            cursor.close()
+            return renewed
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return set()
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    def completeNotification(self, nid, status, next_attempt_at=None, error=None, attempts=None):
+        db = None
+        try:
+            now = int(datetime.now().timestamp())
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute('''
+                UPDATE NotificationOutbox SET status=%s, next_attempt_at=COALESCE(%s, next_attempt_at), last_error=%s,
+                    attempts=COALESCE(%s, attempts), updated_at=%s
+                    WHERE id=%s
+                ''', (status, next_attempt_at, error, attempts, now, nid))
             db.commit()
             cursor.close()
             return True
         except (Exception, psycopg2.DatabaseError) as e:
             logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    def getNotifications(self, alert_id=None, status=None, limit=100):
+        db = None
+        try:
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            conditions = []
+            params = []
+            if alert_id is not None:
+                conditions.append("alert_id = %s")
+                params.append(alert_id)
+            if status is not None:
+                conditions.append("status = %s")
+                params.append(status)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            cursor.execute(f'''
+                SELECT id, alert_id, channel, recipient, status, attempts, next_attempt_at, last_error, created_at, updated_at
+                    FROM NotificationOutbox {where} ORDER BY id DESC LIMIT %s
+                ''', (*params, limit))
+            rows = cursor.fetchall()
+            cursor.close()
+            db.rollback()
+            return rows
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    def getNotificationStats(self):
+        db = None
+        try:
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute("SELECT status, COUNT(*) FROM NotificationOutbox GROUP BY status")
+            rows = cursor.fetchall()
+            cursor.close()
+            db.rollback()
+            return rows
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    # Requeue a dead-lettered delivery, None if there is no such dead letter
+    def retryNotification(self, nid):
+        db = None
+        try:
+            now = int(datetime.now().timestamp())
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute("UPDATE NotificationOutbox SET status='pending', attempts=0, next_attempt_at=%s, updated_at=%s WHERE id=%s AND status='dead'", (now, now, nid))
+            updated = cursor.rowcount
+            db.commit()
+            cursor.close()
+            return True if updated > 0 else None
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    def purgeNotifications(self, before):
+        db = None
+        try:
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM NotificationOutbox WHERE status IN ('sent', 'dead') AND updated_at < %s", (before,))
+            deleted = cursor.rowcount
+            db.commit()
+            cursor.close()
+            return deleted
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
             return False
         finally:
             if db:
@@ -1043,42 +1450,14 @@ class AlertsDatabase:
             rangeStart = datetime.fromisoformat(range_start).timestamp()
             rangeEnd = datetime.fromisoformat(range_end).timestamp()
 
-        query = '''
-            SELECT
-                s.id,
-                s.name,
-                sg.name AS group,
-                sg.id AS group_id,
-                s.starts_at,
-                s.ends_at,
-                s.mute_starts,
-                s.mute_ends,
-                jsonb_agg(
-                    DISTINCT jsonb_build_object(
-                        'name', u.name,
-                        'email', u.email,
-                        'telegram_id', u.telegram_id,
-                        'ntfy', u.ntfy,
-                        'apprise', u.apprise,
-                        'notifiers', u.notifiers
-                    )
-                ) FILTER (WHERE u.id IS NOT NULL) AS people,
-                sg.pipeline_id
-            FROM Schedules s
-            LEFT JOIN ScheduleGroups sg ON s.group_id = sg.id
-            LEFT JOIN LATERAL jsonb_array_elements_text(s.people) AS p(uid) ON TRUE
-            LEFT JOIN Users u ON u.id = p.uid::bigint
-            WHERE s.starts_at <= %s AND s.ends_at >= %s
-            GROUP BY s.id, s.name, sg.name, sg.id, sg.pipeline_id, s.starts_at, s.ends_at, s.mute_starts, s.mute_ends
-        ''' % (rangeStart, rangeEnd)
-
         db = None
         try:
             db = self.cpool.getconn()
             cursor = db.cursor()
-            cursor.execute(query)
+            self.executePrepared(cursor, "matching_schedules", (rangeStart, rangeEnd))
             rows = cursor.fetchall()
             cursor.close()
+            db.rollback()
             if rows is not None:
                 return rows
             else:
@@ -1086,6 +1465,8 @@ class AlertsDatabase:
 
         except (Exception, psycopg2.DatabaseError) as e:
             logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
             return False
 
         finally:
@@ -1101,23 +1482,45 @@ class AlertsDatabase:
             rangeStart = datetime.fromisoformat(range_start).timestamp()
             rangeEnd = datetime.fromisoformat(range_end).timestamp()
 
-        query = '''
-            SELECT * FROM Maintenance WHERE starts_at <= %s AND ends_at >= %s
-        ''' % (rangeStart, rangeEnd)
-
         db = None
         try:
             db = self.cpool.getconn()
             cursor = db.cursor()
-            cursor.execute(query)
+            self.executePrepared(cursor, "matching_maintenance", (rangeStart, rangeEnd))
             rows = cursor.fetchall()
             cursor.close()
+            db.rollback()
             if rows is not None:
                 return rows
             else:
                 return None
         except (Exception, psycopg2.DatabaseError) as e:
             logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
+            return False
+        finally:
+            if db:
+                self.cpool.putconn(db)
+
+    # Maintenance windows that have not ended yet, for the in-memory maintenance index
+    def getActiveMaintenances(self, now=None):
+        if now is None:
+            now = datetime.now().timestamp()
+
+        db = None
+        try:
+            db = self.cpool.getconn()
+            cursor = db.cursor()
+            cursor.execute("SELECT * FROM Maintenance WHERE ends_at >= %s ORDER BY id ASC", (now,))
+            rows = cursor.fetchall()
+            cursor.close()
+            db.rollback()
+            return rows
+        except (Exception, psycopg2.DatabaseError) as e:
+            logging.error(f"Database error: {e}")
+            if db and not db.closed:
+                db.rollback()
             return False
         finally:
             if db:
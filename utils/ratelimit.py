@@ -0,0 +1,220 @@
+import threading
+import heapq
+import itertools
+import time
+import logging
+from collections import OrderedDict
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # set from a retry_after the service sent back, nothing goes out before that
+        self.blocked_until = 0.0
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # Seconds until a token taken now can be used. Tokens go negative while
+    # sends are queued, so waiting callers are served in arrival order.
+    def wait_time(self, now):
+        self.refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def give_back(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+# Token buckets for outbound notifications: one per channel (service wide
+# limit, e.g. ~30 msg/s for a Telegram bot) and one per destination (chat id,
+# ntfy topic, apprise URI). acquire() waits for a slot instead of dropping the
+# send; when the wait would exceed max_wait it takes nothing and returns the
+# time to come back, so callers with a queue (the outbox) can reschedule.
+# Rates are messages per second, a channel without a rate is not limited.
+class RateLimiter:
+    def __init__(self, channel_rates, destination_rates, max_wait=30, max_destinations=10000):
+        self.channel_rates = channel_rates
+        self.destination_rates = destination_rates
+        self.max_wait = max_wait
+        self.max_destinations = max_destinations
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.destinations = OrderedDict()
+        self.counters = {
+            "acquired": 0,
+            "delayed": 0,
+            "deferred": 0,
+            "throttled": 0,
+            "wait_time": 0.0,
+        }
+
+    def bucket(self, buckets, key, rate, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, max(1.0, rate), now)
+            buckets[key] = bucket
+        return bucket
+
+    def destination_bucket(self, channel, destination, now):
+        rate = self.destination_rates.get(channel)
+        if not rate:
+            return None
+        key = (channel, str(destination))
+        bucket = self.bucket(self.destinations, key, rate, now)
+        self.destinations.move_to_end(key)
+        while len(self.destinations) > self.max_destinations:
+            self.destinations.popitem(last=False)
+        return bucket
+
+    def channel_bucket(self, channel, now):
+        rate = self.channel_rates.get(channel)
+        if not rate:
+            return None
+        return self.bucket(self.channels, channel, rate, now)
+
+    # Reserve a token in the bucket, None if that means waiting longer than max_wait
+    def reserve(self, bucket, max_wait):
+        now = time.monotonic()
+        wait = bucket.wait_time(now)
+        if wait > max_wait:
+            return None
+        bucket.take()
+        return wait
+
+    # None once the send may go out, otherwise the seconds to wait before trying again.
+    # The destination slot is taken first and the channel slot only when it comes up,
+    # so sends queued for a busy chat don't hold back the rest of the channel. Both
+    # are checked before taking either, a deferred send uses up no token.
+    def acquire(self, channel, destination, max_wait=None):
+        if max_wait is None:
+            max_wait = self.max_wait
+        with self.lock:
+            now = time.monotonic()
+            buckets = (self.destination_bucket(channel, destination, now), self.channel_bucket(channel, now))
+            wait = max((bucket.wait_time(now) for bucket in buckets if bucket is not None), default=0.0)
+            if wait > max_wait:
+                self.counters["deferred"] += 1
+                return max(wait, 1.0)
+        deadline = now + max_wait
+        retry = self.take_slot(channel, destination, deadline)
+        if retry is None:
+            retry = self.take_slot(channel, None, deadline)
+            if retry is not None:
+                # The channel filled up meanwhile, the destination slot goes unused
+                with self.lock:
+                    bucket = self.destination_bucket(channel, destination, time.monotonic())
+                    if bucket is not None:
+                        bucket.give_back()
+        if retry is None:
+            with self.lock:
+                self.counters["acquired"] += 1
+        return retry
+
+    # Wait for a token of the destination bucket (channel bucket if destination is None)
+    def take_slot(self, channel, destination, deadline):
+        with self.lock:
+            now = time.monotonic()
+            if destination is not None:
+                bucket = self.destination_bucket(channel, destination, now)
+            else:
+                bucket = self.channel_bucket(channel, now)
+            if bucket is None:
+                return None
+            wait = self.reserve(bucket, deadline - now)
+            if wait is None:
+                self.counters["deferred"] += 1
+                return max(bucket.wait_time(now), 1.0)
+            if wait > 0:
+                self.counters["delayed"] += 1
+                self.counters["wait_time"] += wait
+        if wait > 0:
+            time.sleep(wait)
+        return None
+
+    # The service answered 429, hold back this destination for retry_after seconds
+    def throttle(self, channel, destination, retry_after):
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.destination_bucket(channel, destination, now) or self.channel_bucket(channel, now)
+            if bucket is None:
+                return
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            self.counters["throttled"] += 1
+        logging.warning(f"Rate limit: {channel} {destination} throttled for {retry_after}s")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "channels": self.channel_rates,
+                "destinations": len(self.destinations),
+                **self.counters,
+            }
+
+# Sends deferred by the rate limiter when there is no outbox. They are kept in
+# memory and handed to sender(*args) again once their retry_after has passed;
+# a send deferred again is rescheduled, so excess sends are delayed, not dropped.
+# Only a full queue (maxsize) drops sends.
+class DeferredSends:
+    def __init__(self, sender, maxsize=10000):
+        self.sender = sender
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        # heap of (due, seq, args)
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+        self.counters = {
+            "deferred": 0,
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+        }
+
+    # False if the queue is full
+    def schedule(self, delay, *args):
+        with self.lock:
+            if len(self.heap) >= self.maxsize:
+                self.counters["dropped"] += 1
+                return False
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), args))
+            self.counters["deferred"] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.worker, daemon=True)
+                self.thread.start()
+            self.ready.notify()
+        return True
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.ready.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, args = heapq.heappop(self.heap)
+            try:
+                res = self.sender(*args)
+            except Exception as e:
+                res = {"ok": False, "response": str(e)}
+            if res.get('deferred'):
+                with self.lock:
+                    heapq.heappush(self.heap, (time.monotonic() + res['retry_after'], next(self.seq), args))
+                continue
+            with self.lock:
+                self.counters["sent" if res['ok'] else "failed"] += 1
+            if not res['ok']:
+                logging.error(f"Deferred notification failed: {res.get('response')}")
+
+    def stats(self):
+        with self.lock:
+            return {"queued": len(self.heap), **self.counters}
@@ -0,0 +1,73 @@
+import threading
+import hashlib
+import logging
+from collections import OrderedDict
+import jinja2
+import config
+from utils.cache import register_cache
+
+# Jinja environment shared by all notifiers and the template preview endpoint
+env = jinja2.Environment(
+    autoescape=False,
+    trim_blocks=False,
+    lstrip_blocks=False
+)
+
+# Compiled templates keyed by (template id, content hash). The hash keeps an
+# edited template from ever hitting an old entry, invalidate() only frees them.
+# Ad-hoc templates without an id are cached by content alone. Previews
+# (cache=False) are compiled for one render and never cached, so they can't push
+# the templates in use out.
+class TemplateRenderer:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.templates = OrderedDict()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+        register_cache("templates_compiled", self)
+
+    def compile(self, template: str, template_id=None, cache=True) -> jinja2.Template:
+        if not cache:
+            return env.from_string(template)
+        key = (template_id, hashlib.sha1(template.encode('utf-8')).hexdigest())
+        with self.lock:
+            tpl = self.templates.get(key)
+            if tpl is not None:
+                self.templates.move_to_end(key)
+                self.counters["hits"] += 1
+                return tpl
+            self.counters["misses"] += 1
+        # Syntax errors are raised to the caller and never cached
+        tpl = env.from_string(template)
+        with self.lock:
+            self.templates[key] = tpl
+            while len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+                self.counters["evictions"] += 1
+        return tpl
+
+    def render(self, template: str, context: dict, template_id=None, cache=True) -> str:
+        return self.compile(template, template_id, cache).render(context)
+
+    def invalidate(self, template_id):
+        with self.lock:
+            keys = [key for key in self.templates if key[0] == template_id]
+            for key in keys:
+                del self.templates[key]
+            self.counters["invalidations"] += len(keys)
+        if keys:
+            logging.debug(f"Template {template_id}: {len(keys)} compiled version(s) dropped")
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.templates), "maxsize": self.maxsize, **self.counters}
+
+renderer = TemplateRenderer(getattr(config, 'TEMPLATE_CACHE_SIZE', 256))
+
+def render_template(template: str, context: dict, template_id=None, cache=True) -> str:
+    return renderer.render(template, context, template_id, cache)
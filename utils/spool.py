@@ -0,0 +1,258 @@
+import os
+import mmap
+import json
+import struct
+import threading
+import time
+import zlib
+import logging
+
+# Returned by store handlers that spooled the payload instead of storing it
+SPOOLED = object()
+
+# Append-only on-disk spool for webhook payloads that could not be stored in
+# Postgres. Payloads are appended to numbered segment files as
+# <length><crc32><json> records and fsync'ed in batches. A replayer thread
+# drains closed segments in order once the database is healthy again.
+# A segment with a corrupt or truncated record is replayed up to that record
+# and kept as <segment>.bad for manual recovery.
+class IngestSpool:
+    HEADER = struct.Struct(">II")
+    SUFFIX = ".seg"
+    BAD_SUFFIX = ".bad"
+    # Alerts the database rejected, one JSON object per line, kept for inspection
+    REJECTED = "rejected.jsonl"
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024, fsync_batch=64, fsync_interval=1.0, replay_interval=5, replay_batch=500):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.replay_interval = replay_interval
+        self.replay_batch = replay_batch
+        self.lock = threading.Lock()
+        self.replay_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.active = None
+        self.active_seq = 0
+        self.active_records = 0
+        self.unsynced = 0
+        self.first_unsynced = 0.0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.closed = sorted(self.list_segments())
+        if self.closed:
+            self.active_seq = self.closed[-1]
+            logging.warning(f"Spool: {len(self.closed)} segment(s) left from the previous run")
+
+        self.spooled = 0
+        self.replayed = 0
+        self.rejected = 0
+        self.corrupt_records = 0
+        self.bad_segments = 0
+
+    def list_segments(self):
+        return [int(f[:-len(self.SUFFIX)]) for f in os.listdir(self.path) if f.endswith(self.SUFFIX)]
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, f"{seq:020d}{self.SUFFIX}")
+
+    def checkpoint_path(self, seq):
+        return self.segment_path(seq) + ".pos"
+
+    def pending(self):
+        with self.lock:
+            return len(self.closed) > 0 or self.active_records > 0
+
+    def append(self, alerts):
+        data = json.dumps(alerts, separators=(',', ':')).encode('utf-8')
+        record = self.HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            if self.active is None:
+                self.active_seq += 1
+                self.active = open(self.segment_path(self.active_seq), "ab")
+            self.active.write(record)
+            self.active.flush()
+            self.active_records += 1
+            self.spooled += len(alerts)
+            if self.unsynced == 0:
+                self.first_unsynced = time.monotonic()
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_batch:
+                self.sync_locked()
+            if self.active.tell() >= self.segment_size:
+                self.rotate_locked()
+        logging.warning(f"Spool: {len(alerts)} alerts written to segment {self.active_seq}")
+
+    # Dead-letter alerts that can never be stored (malformed or rejected by the
+    # database) so they don't block replay
+    def reject(self, alerts):
+        if not alerts:
+            return
+        with self.lock:
+            with open(os.path.join(self.path, self.REJECTED), "a") as f:
+                for alert in alerts:
+                    f.write(json.dumps(alert, separators=(',', ':')) + "\n")
+            self.rejected += len(alerts)
+        logging.error(f"Spool: {len(alerts)} rejected alerts written to {self.REJECTED}")
+
+    def sync(self, force=False):
+        with self.lock:
+            if self.unsynced > 0 and (force or time.monotonic() - self.first_unsynced >= self.fsync_interval):
+                self.sync_locked()
+
+    def sync_locked(self):
+        if self.active is not None:
+            os.fsync(self.active.fileno())
+        self.unsynced = 0
+
+    def rotate_locked(self):
+        if self.active is None:
+            return
+        self.sync_locked()
+        self.active.close()
+        self.active = None
+        if self.active_records > 0:
+            self.closed.append(self.active_seq)
+        else:
+            os.remove(self.segment_path(self.active_seq))
+        self.active_records = 0
+
+    # (end offset, alerts) per record; a bad record ends the segment with
+    # (its offset, None)
+    def read_segment(self, seq, offset):
+        path = self.segment_path(seq)
+        if os.path.getsize(path) <= offset:
+            return
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = offset
+                size = len(mm)
+                while pos + self.HEADER.size <= size:
+                    length, crc = self.HEADER.unpack_from(mm, pos)
+                    start = pos + self.HEADER.size
+                    end = start + length
+                    if end > size:
+                        logging.error(f"Spool: truncated record in {path} at offset {pos}")
+                        yield pos, None
+                        return
+                    data = mm[start:end]
+                    if zlib.crc32(data) != crc:
+                        logging.error(f"Spool: corrupted record in {path} at offset {pos}")
+                        yield pos, None
+                        return
+                    yield end, json.loads(data)
+                    pos = end
+                if pos < size:
+                    logging.error(f"Spool: truncated record header in {path} at offset {pos}")
+                    yield pos, None
+
+    def load_checkpoint(self, seq):
+        try:
+            with open(self.checkpoint_path(seq)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def save_checkpoint(self, seq, offset):
+        tmp = self.checkpoint_path(seq) + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path(seq))
+
+    def drop_segment(self, seq):
+        os.remove(self.segment_path(seq))
+        if os.path.exists(self.checkpoint_path(seq)):
+            os.remove(self.checkpoint_path(seq))
+
+    # Keep a segment with a bad record for recovery, everything before offset was replayed
+    def quarantine_segment(self, seq, offset):
+        path = self.segment_path(seq)
+        os.replace(path, path + self.BAD_SUFFIX)
+        if os.path.exists(self.checkpoint_path(seq)):
+            os.remove(self.checkpoint_path(seq))
+        logging.error(f"Spool: records from offset {offset} of segment {seq} were not replayed, "
+                      f"segment kept as {path + self.BAD_SUFFIX}")
+
+    # Replay spooled payloads in order through store(alerts) -> bool.
+    # Alerts are handed over in bulk, a failed store leaves the rest for the next round.
+    def replay(self, store):
+        with self.replay_lock:
+            with self.lock:
+                self.rotate_locked()
+                segments = list(self.closed)
+
+            for seq in segments:
+                offset = self.load_checkpoint(seq)
+                batch = []
+                bad_offset = None
+                for end, alerts in self.read_segment(seq, offset):
+                    if alerts is None:
+                        bad_offset = end
+                        break
+                    batch.extend(alerts)
+                    offset = end
+                    if len(batch) >= self.replay_batch:
+                        if not store(batch):
+                            return False
+                        self.replayed += len(batch)
+                        self.save_checkpoint(seq, offset)
+                        batch = []
+                if batch:
+                    if not store(batch):
+                        return False
+                    self.replayed += len(batch)
+                    self.save_checkpoint(seq, offset)
+                with self.lock:
+                    self.closed.remove(seq)
+                    if bad_offset is not None:
+                        self.corrupt_records += 1
+                        self.bad_segments += 1
+                if bad_offset is not None:
+                    self.quarantine_segment(seq, bad_offset)
+                    continue
+                self.drop_segment(seq)
+                logging.info(f"Spool: segment {seq} replayed")
+            return True
+
+    def start(self, store, healthy):
+        self.thread = threading.Thread(target=self.replayer, args=(store, healthy), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(self.replay_interval * 2)
+        with self.lock:
+            self.sync_locked()
+            if self.active is not None:
+                self.active.close()
+                self.active = None
+
+    def replayer(self, store, healthy):
+        next_replay = 0.0
+        while not self.stop_event.wait(min(self.fsync_interval, self.replay_interval)):
+            try:
+                self.sync()
+                if time.monotonic() >= next_replay and self.pending():
+                    next_replay = time.monotonic() + self.replay_interval
+                    if healthy():
+                        self.replay(store)
+            except Exception as e:
+                logging.error(f"Spool replay error: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "segments": len(self.closed) + (1 if self.active_records > 0 else 0),
+                "active_records": self.active_records,
+                "spooled": self.spooled,
+                "replayed": self.replayed,
+                "rejected": self.rejected,
+                "corrupt_records": self.corrupt_records,
+                "bad_segments": self.bad_segments,
+            }
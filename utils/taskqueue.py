@@ -0,0 +1,184 @@
+import threading
+import heapq
+import itertools
+import time
+from collections import deque
+
+class QueuedTask:
+    __slots__ = ("key", "keys", "task", "enqueued_at")
+
+    def __init__(self, key, keys, task, enqueued_at):
+        self.key = key
+        self.keys = keys
+        self.task = task
+        self.enqueued_at = enqueued_at
+
+# Members of a key, a list of keys is a task that holds all of them
+def key_members(key):
+    if isinstance(key, list):
+        return tuple(dict.fromkeys(key))
+    return (key,)
+
+# Task queue that keeps tasks with the same key (alert fingerprint) in order.
+# Every key has its own FIFO and is handed to one worker at a time: the next
+# task of a key only becomes ready after task_done() for the previous one, so
+# a "resolved" can't overtake the "firing" it follows. Different keys run in
+# parallel.
+# A task put with a list of keys (a batch of alerts) is queued in the FIFO of
+# each of them and only becomes ready once it is first in all of them and none
+# is running, so it keeps its place in the order of every member key. Tasks
+# are queued in all their FIFOs at once, so there is always a first task that
+# can run.
+# Ready tasks go to the shard of hash(key); each worker takes from its own shard
+# first and steals from the others when that one is empty.
+# Shards are heaps ordered by the enqueue time of the ready tasks. With a
+# priority function (task -> boost in seconds) the order is enqueue time minus
+# boost and workers take the best key of any shard: a task boosted by 600s
+# goes ahead of everything queued less than 600s before it, and anything that
+# waited longer still goes first, so low priority tasks can't starve.
+class KeyedTaskQueue:
+    def __init__(self, num_shards, priority=None):
+        self.num_shards = max(1, num_shards)
+        self.priority = priority
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+        # key -> deque of pending QueuedTask (the running one is not included)
+        self.pending = {}
+        self.busy = set()
+        # per shard heap of (score, seq, QueuedTask)
+        self.ready = [[] for _ in range(self.num_shards)]
+        self.seq = itertools.count()
+        self.ready_count = 0
+        self.size = 0
+        self.unfinished = 0
+        self.closed = False
+        self.counters = {
+            "put": 0,
+            "done": 0,
+            "steals": 0,
+        }
+
+    def shard(self, key):
+        return hash(key) % self.num_shards
+
+    def put(self, key, task):
+        with self.lock:
+            entry = QueuedTask(key, key_members(key), task, time.monotonic())
+            for member in entry.keys:
+                tasks = self.pending.get(member)
+                if tasks is None:
+                    tasks = self.pending[member] = deque()
+                tasks.append(entry)
+            self.size += 1
+            self.unfinished += 1
+            self.counters["put"] += 1
+            # Tasks behind others of their keys are picked up again by task_done()
+            if self.push_ready(entry):
+                self.not_empty.notify()
+
+    # Queue the task for the workers if it is first of all its keys, none of them running
+    def push_ready(self, entry):
+        for member in entry.keys:
+            if member in self.busy or self.pending[member][0] is not entry:
+                return False
+        score = entry.enqueued_at
+        if self.priority is not None:
+            score -= self.priority(entry.task)
+        heapq.heappush(self.ready[self.shard(entry.keys[0])], (score, next(self.seq), entry))
+        self.ready_count += 1
+        return True
+
+    def pop_ready(self, shard):
+        shard = shard % self.num_shards
+        own = self.ready[shard]
+        heap = None
+        if self.priority is not None:
+            # Best score of all shards
+            for other in self.ready:
+                if other and (heap is None or other[0] < heap[0]):
+                    heap = other
+        elif own:
+            heap = own
+        else:
+            for i in range(1, self.num_shards):
+                other = self.ready[(shard + i) % self.num_shards]
+                if other:
+                    heap = other
+                    break
+        if heap is None:
+            return None
+        if heap is not own:
+            self.counters["steals"] += 1
+        self.ready_count -= 1
+        return heapq.heappop(heap)[2]
+
+    # (key, task) for the worker of the given shard, None once closed and drained
+    # or after timeout. The key is passed back to task_done()
+    def get(self, shard, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.ready_count == 0:
+                if self.closed and self.size == 0:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.not_empty.wait(remaining)
+            entry = self.pop_ready(shard)
+            for member in entry.keys:
+                self.pending[member].popleft()
+                self.busy.add(member)
+            self.size -= 1
+            return entry.key, entry.task
+
+    def task_done(self, key):
+        with self.lock:
+            heads = {}
+            for member in key_members(key):
+                self.busy.discard(member)
+                tasks = self.pending.get(member)
+                if tasks:
+                    heads[id(tasks[0])] = tasks[0]
+                elif tasks is not None:
+                    del self.pending[member]
+            for entry in heads.values():
+                if self.push_ready(entry):
+                    self.not_empty.notify()
+            self.unfinished -= 1
+            self.counters["done"] += 1
+            if self.unfinished == 0:
+                self.all_done.notify_all()
+            if self.closed and self.size == 0:
+                self.not_empty.notify_all()
+
+    def join(self):
+        with self.lock:
+            while self.unfinished:
+                self.all_done.wait()
+
+    # Workers finish the queued tasks, then get() returns None
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+
+    # (tasks a worker could take now, seconds the oldest of them has been waiting).
+    # Tasks queued behind a running task of their key are not counted, more
+    # workers wouldn't get them done any sooner.
+    def ready_backlog(self):
+        with self.lock:
+            oldest = min((entry.enqueued_at for heap in self.ready for _, _, entry in heap), default=None)
+            return self.ready_count, time.monotonic() - oldest if oldest is not None else 0.0
+
+    def stats(self):
+        with self.lock:
+            oldest = min((tasks[0].enqueued_at for tasks in self.pending.values() if tasks), default=None)
+            return {
+                "queued": self.size,
+                "oldest_age": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+                "running": len(self.busy),
+                "keys": len(self.pending),
+                "ready_keys": self.ready_count,
+                **self.counters,
+            }
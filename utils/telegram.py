@@ -1,7 +1,7 @@
 import logging
-import requests
-import jinja2
 from requests.exceptions import RequestException
+from utils.render import render_template
+from utils import httpclient
 
 class TelegramNotify:
     BASE_URL = "https://api.telegram.org"
@@ -13,15 +13,8 @@ class TelegramNotify:
         self.parse_mode = parse_mode
         self.api_url = f"{self.BASE_URL}/bot{self.bot_token}/sendMessage"
 
-        self.env = jinja2.Environment(
-            autoescape=False,
-            trim_blocks=False,
-            lstrip_blocks=False
-        )
-
-    def render_message(self, template: str, context: dict) -> str:
-        tpl = self.env.from_string(template)
-        return tpl.render(context)
+    def render_message(self, template: str, context: dict, template_id=None) -> str:
+        return render_template(template, context, template_id)
 
     def send_raw_message(self, chat_id: str, msg: str):
         payload = {
@@ -31,7 +24,20 @@ class TelegramNotify:
         }
 
         try:
-            response = requests.post(self.api_url, json=payload, timeout=10)
+            response = httpclient.post("telegram", self.api_url, json=payload)
+            if response.status_code == 429:
+                # The body may not be Telegram's JSON (e.g. a proxy error page)
+                retry_after = None
+                try:
+                    result = response.json()
+                    retry_after = result.get("parameters", {}).get("retry_after")
+                except (ValueError, AttributeError):
+                    result = response.text
+                if retry_after is None:
+                    retry_after = response.headers.get("Retry-After", "1")
+                    retry_after = int(retry_after) if retry_after.isdigit() else 1
+                logging.warning("Telegram rate limit hit, retry after %ss", retry_after)
+                return {"ok": False, "response": result, "retry_after": retry_after}
             response.raise_for_status()
             result = response.json()
 
@@ -40,12 +46,11 @@ class TelegramNotify:
                 return {"ok": False, "response": result}
             else:
                 return {"ok": True, "response": result}
-            return result
 
         except RequestException as e:
             logging.error("Telegram send_message failed: %s", e)
             return {"ok": False, "response": str(e)}
 
-    def send_alert(self, chat_id: str, template: str, alert: dict) -> dict:
-        bot_msg = self.render_message(template, alert)
-        self.send_raw_message(chat_id, bot_msg)
+    def send_alert(self, chat_id: str, template: str, alert: dict, template_id=None) -> dict:
+        bot_msg = self.render_message(template, alert, template_id)
+        return self.send_raw_message(chat_id, bot_msg)
@@ -0,0 +1,67 @@
+import threading
+import logging
+
+# Notification templates by id. Missing ids are fetched together with a single
+# getTemplatesByIds() query. With a cache (utils.cache.Cache) the registry is
+# shared by all pipeline workers, without one every call goes to the database.
+class TemplateRegistry:
+    def __init__(self, db_handler, cache=None):
+        self.db = db_handler
+        self.cache = cache
+        self.load_lock = threading.Lock()
+
+    # id -> template text for the ids that exist
+    def get_many(self, tids):
+        tids = {int(tid) for tid in tids}
+        if not tids:
+            return {}
+        if self.cache is None:
+            return self.fetch(tids) or {}
+
+        found = {}
+        missing = set()
+        for tid in tids:
+            hit, tpl = self.cache.lookup(tid)
+            if not hit:
+                missing.add(tid)
+            elif tpl is not None:
+                found[tid] = tpl
+        if not missing:
+            return found
+
+        # One worker loads, the others pick the result up from the cache
+        with self.load_lock:
+            still_missing = set()
+            for tid in missing:
+                hit, tpl = self.cache.lookup(tid)
+                if not hit:
+                    still_missing.add(tid)
+                elif tpl is not None:
+                    found[tid] = tpl
+            if still_missing:
+                generation = self.cache.generation
+                loaded = self.fetch(still_missing)
+                if loaded is not None:
+                    for tid in still_missing:
+                        # Unknown ids are cached as None until the next template change
+                        self.cache.set(tid, loaded.get(tid), generation)
+                    found.update(loaded)
+        return found
+
+    def get(self, tid):
+        return self.get_many([tid]).get(int(tid))
+
+    def fetch(self, tids):
+        rows = self.db.getTemplatesByIds(sorted(tids))
+        if rows is False:
+            logging.error(f"Error loading templates {sorted(tids)}")
+            return None
+        return {row[0]: row[1] for row in rows}
+
+    def invalidate(self, tid=None):
+        if self.cache is None:
+            return
+        if tid is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(int(tid))